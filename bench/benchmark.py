@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+"""Benchmarks for loading, saving, compiling, and rendering presentations.
+
+Synthetic presentations are compiled with fakelatex.py instead of LaTeX,
+so no TeX installation is needed.  Loading, saving, and compiling go
+through the code shared by the editor and headless builds, which needs
+no GUI: compiling is timed both as the headless build runs it, and with
+the processes run from the glib main loop, as by the editor's pipe
+backend.  That needs glib, and rendering thumbnails and pages needs PyGTK
+and Poppler; they are marked as skipped without them.  The results are
+written as JSON, one record per benchmark and size, so runs may be
+compared.  Times are in seconds; those of the thumbnail and render
+benchmarks are per slide rendered.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import optparse
+import tempfile
+import subprocess
+
+BENCHPATH = os.path.dirname(os.path.realpath(os.path.abspath(__file__)))
+LIBPATH = os.path.join(os.path.dirname(BENCHPATH), 'lib')
+sys.path.insert(0, LIBPATH)
+import misc
+misc.LIBPATH = LIBPATH
+from misc import SEP, format_segment, replace_file
+from headless import HeadlessDocument
+
+SLIDE = r"""\begin{frame}{Slide %(i)i}
+  \begin{itemize}
+  \item The first point of slide %(i)i, with $x_%(i)i^2 + y^2 = r^2$.
+  \item The second point, with \textbf{bold} and \emph{emphasized} text.
+  \item The third point.
+  \end{itemize}
+\end{frame}
+"""
+
+def make_deck(dirname, nslides, header_lines, delay, jobs):
+    """Write a presentation of nslides slides into dirname, and return its filename.
+    
+    The header has header_lines lines of macro definitions, to stand in for
+    heavy preambles.  Each slide is compiled by fakelatex.py, sleeping for
+    delay seconds, with up to jobs at once."""
+    command = '%s %s --delay %g {fn}' % (sys.executable, os.path.join(BENCHPATH, 'fakelatex.py'),
+                                         delay)
+    # Build inside dirname, so everything is cleaned up with it.
+    settings = ('[commands]\nslide = %s\npresentation = %s\n[build]\ncache_size = 0\n'
+                'assemble = never\ndirectory = build-%i\nbackend = pipe\njobs = %i\n'
+                % (command, command, nslides, jobs))
+    header = '\\documentclass{beamer}\n'
+    # Macro names can't contain digits, so spell the numbers in letters.
+    header += ''.join('\\newcommand{\\macro%s}{Macro number %i}\n'
+                      % (''.join(chr(97 + int(d)) for d in str(i)), i)
+                      for i in range(header_lines))
+    header += '\\begin{document}\n'
+    fn = os.path.join(dirname, 'bench-%i.tex' % nslides)
+    f = file(fn, 'w')
+    f.write(SEP + '\n' + ''.join('% ' + line + '\n' for line in settings.splitlines()))
+    f.write(format_segment('', header))
+    for i in range(nslides):
+        f.write(format_segment('.tmpbench%i' % i, SLIDE % {'i': i}))
+    f.write(format_segment('', '\\end{document}\n'))
+    f.close()
+    return fn
+
+def timeit(func, repeat):
+    """Call func repeat times, and return the times taken."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+def run_until(done):
+    """Run the glib main loop until done() is true."""
+    import glib
+    context = glib.main_context_default()
+    while not done():
+        context.iteration(True)
+
+def forget_builds(doc):
+    """Make doc compile every slide again, by dropping its build index."""
+    if os.path.exists(doc.build_index.path):
+        os.unlink(doc.build_index.path)
+    doc._index = None
+
+def bench_load(fn, repeat):
+    return timeit(lambda: HeadlessDocument(fn), repeat)
+
+def bench_serialize(doc, repeat):
+    return timeit(doc.serialize, repeat)
+
+def bench_save(doc, repeat):
+    return timeit(lambda: replace_file(doc.fullfilename, doc.write), repeat)
+
+def bench_compile(doc, repeat, jobs):
+    devnull = file(os.devnull, 'w')
+    def compile():
+        forget_builds(doc)
+        if doc.build(jobs, devnull) != 0:
+            raise RuntimeError('%s failed to build' % doc.fullfilename)
+    try:
+        return timeit(compile, repeat)
+    finally:
+        devnull.close()
+
+def bench_compile_pipe(doc, repeat, jobs):
+    # The processes are run from the glib main loop, as by the editor's
+    # pipe backend, with up to jobs at once.
+    from processrunner import Process
+    command = doc.settings.slide_command(doc.header, doc.dvi_slides)
+    def compile():
+        forget_builds(doc)
+        pending = doc.slide_jobs(command)
+        running = []
+        failed = []
+        def start():
+            while pending and len(running) < jobs:
+                job = pending.pop(0)
+                running.append(job)
+                run(job, list(job.commands))
+        def run(job, commands):
+            def done(status, output):
+                if status == 0 and commands:
+                    run(job, commands)
+                    return
+                if status != 0:
+                    failed.append(job)
+                running.remove(job)
+                start()
+            Process(commands.pop(0), doc.build_dir, done)
+        start()
+        run_until(lambda: not pending and not running)
+        if failed:
+            raise RuntimeError('%s failed to build' % failed[0].fn)
+    return timeit(compile, repeat)
+
+def bench_thumbnail(pdfs, repeat):
+    from thumbnailer import Thumbnailer
+    thumbnailer = Thumbnailer()
+    def render():
+        done = []
+        for pdffn in pdfs:
+            thumbnailer.render(pdffn, done.append)
+        run_until(lambda: len(done) == len(pdfs))
+    return [t / len(pdfs) for t in timeit(render, repeat)]
+
+def bench_render(pdfs, repeat, cached):
+    import poppler
+    from pdfviewer import PDFViewer, PixbufCache
+    docs = [poppler.document_new_from_file('file://' + pdffn, None) for pdffn in pdfs]
+    size = (1024, 768)
+    # Just the parts of the viewer that get_pixbuf() uses.  Without room
+    # in the cache, every page is rendered again.
+    viewer = PDFViewer.__new__(PDFViewer)
+    viewer.cache = PixbufCache(cached and 256 * 1024 * 1024 or 0)
+    def render():
+        for pdf in docs:
+            viewer.doc = pdf
+            viewer.get_pixbuf(0, size)
+    if cached:
+        render()
+    return [t / len(docs) for t in timeit(render, repeat)]
+
+BENCHMARKS = ['load', 'serialize', 'save', 'compile', 'compile_pipe', 'thumbnail', 'render',
+              'render_cached']
+
+def result(name, nslides, options, times, per_slide=False):
+    times = sorted(times)
+    record = dict(benchmark=name, slides=nslides, header_lines=options.header_lines,
+                  repeat=len(times), min=times[0], median=times[len(times) // 2])
+    if per_slide:
+        record['per_slide'] = record['median'] / nslides
+    return record
+
+def environment():
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=BENCHPATH,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                                  ).communicate()[0].strip()
+    except OSError:
+        commit = ''
+    return dict(time=time.time(), python=platform.python_version(), platform=platform.platform(),
+                commit=commit or None)
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sizes', default='10,100,1000',
+                      help="comma-separated numbers of slides (default: %default)")
+    parser.add_option('--header-lines', type='int', default=50,
+                      help="lines of macro definitions in the header (default: %default)")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="times to run each benchmark (default: %default)")
+    parser.add_option('-j', '--jobs', type='int', default=4,
+                      help="slides to compile at once (default: %default)")
+    parser.add_option('--delay', type='float', default=0,
+                      help="seconds the fake LaTeX takes for each slide (default: %default)")
+    parser.add_option('--render-limit', type='int', default=100,
+                      help="most slides to render in the thumbnail and render benchmarks "
+                           "(default: %default)")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="write the results to FILE, rather than standard output")
+    options, args = parser.parse_args(argv)
+    
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='slidedex-bench-')
+    try:
+        for nslides in [int(s) for s in options.sizes.split(',')]:
+            fn = make_deck(tmpdir, nslides, options.header_lines, options.delay, options.jobs)
+            doc = HeadlessDocument(fn)
+            # Rendered once they have been compiled.
+            pdfs = [os.path.join(doc.build_dir, filename) + '.pdf'
+                    for filename, content in doc.slides[:options.render_limit]]
+            benchmarks = [
+                ('load', lambda: bench_load(fn, options.repeat)),
+                ('serialize', lambda: bench_serialize(doc, options.repeat)),
+                ('save', lambda: bench_save(doc, options.repeat)),
+                ('compile', lambda: bench_compile(doc, options.repeat, options.jobs)),
+                ('compile_pipe', lambda: bench_compile_pipe(doc, options.repeat, options.jobs)),
+                ('thumbnail', lambda: bench_thumbnail(pdfs, options.repeat)),
+                ('render', lambda: bench_render(pdfs, options.repeat, False)),
+                ('render_cached', lambda: bench_render(pdfs, options.repeat, True))]
+            for name, bench in benchmarks:
+                try:
+                    times = bench()
+                except ImportError, e:
+                    # Only rendering needs PyGTK and Poppler, and the pipe
+                    # backend glib.
+                    results.append(dict(benchmark=name, slides=nslides, skipped=str(e)))
+                    continue
+                results.append(result(name, nslides, options, times,
+                                      name.startswith('compile')))
+                if name.startswith('compile'):
+                    results[-1]['jobs'] = options.jobs
+                elif name in ('thumbnail', 'render', 'render_cached'):
+                    results[-1]['rendered'] = len(pdfs)
+            sys.stderr.write('%i slides done\n' % nslides)
+    finally:
+        shutil.rmtree(tmpdir)
+    
+    out = options.output and file(options.output, 'w') or sys.stdout
+    json.dump(dict(environment=environment(), results=results), out, indent=1, sort_keys=True)
+    out.write('\n')
+    if options.output:
+        out.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
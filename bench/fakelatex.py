@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+"""A stand-in for pdflatex, for benchmarks on machines without TeX.
+
+    fakelatex.py [--delay SECONDS] [options] BASENAME
+
+Reads BASENAME.tex, as LaTeX would, and writes a one-page BASENAME.pdf.
+Other options are ignored.  Fails, like LaTeX with -halt-on-error, if the
+source contains \\undefined.
+"""
+
+import sys
+import time
+
+def pdf(text):
+    """Return a minimal, valid PDF with a single page showing text."""
+    stream = 'BT /F1 24 Tf 72 720 Td (%s) Tj ET' % text.replace('\\', '').replace('(', '') \
+                                                          .replace(')', '')
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+               '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+               '/Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+               '<< /Length %i >>\nstream\n%s\nendstream' % (len(stream), stream),
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    out = '%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += '%i 0 obj\n%s\nendobj\n' % (i + 1, obj)
+    xref = len(out)
+    out += 'xref\n0 %i\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += ''.join('%010i 00000 n \n' % o for o in offsets)
+    out += 'trailer\n<< /Size %i /Root 1 0 R >>\nstartxref\n%i\n%%%%EOF\n' % (len(objects) + 1,
+                                                                              xref)
+    return out
+
+def main(argv):
+    delay = 0
+    if argv[:1] == ['--delay']:
+        delay = float(argv[1])
+        argv = argv[2:]
+    fn = argv[-1]
+    source = file(fn + '.tex').read()
+    if '\\undefined' in source:
+        print '! Undefined control sequence.'
+        return 1
+    time.sleep(delay)
+    lines = [l for l in source.split('\n') if l and not l.startswith('\\')]
+    f = file(fn + '.pdf', 'w')
+    f.write(pdf(lines and lines[0][:40] or fn))
+    f.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
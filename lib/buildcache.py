@@ -0,0 +1,88 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import shutil
+import hashlib
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class BuildCache(object):
+    """A content-addressed store of compiled slides.
+    
+    PDFs are stored under a digest of the complete source of the slide and
+    the command used to compile it.  Any slide that has been compiled before,
+    in this or another presentation in the same directory, can be reused
+    without running LaTeX.  Once the cache grows beyond max_size bytes, the
+    least recently used entries are removed.
+    """
+    
+    def __init__(self, dir, max_size):
+        self.dir = dir
+        self.max_size = max_size
+        self._entries = None
+    
+    @staticmethod
+    def key(source, command):
+        return hashlib.sha1(command + '\0' + source).hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.dir, key + '.pdf')
+    
+    @property
+    def entries(self):
+        # Map of key -> size, from least to most recently used.  The
+        # modification times of the files record the order between sessions.
+        if self._entries is None:
+            self._entries = OrderedDict()
+            if os.path.isdir(self.dir):
+                files = []
+                for fn in os.listdir(self.dir):
+                    if fn.endswith('.pdf'):
+                        st = os.stat(os.path.join(self.dir, fn))
+                        files.append((st.st_mtime, fn[:-4], st.st_size))
+                for mtime, key, size in sorted(files):
+                    self._entries[key] = size
+        return self._entries
+    
+    def fetch(self, key, filename):
+        """Copy the PDF stored under key to filename.  Returns whether it was found."""
+        size = self.entries.pop(key, None)
+        if size is None:
+            return False
+        try:
+            # Copy, rather than link, since LaTeX overwrites its output in place.
+            shutil.copyfile(self.path(key), filename)
+            os.utime(self.path(key), None)
+        except (IOError, OSError):
+            return False
+        self.entries[key] = size
+        return True
+    
+    def store(self, key, filename):
+        """Store a copy of the PDF filename under key."""
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        path = self.path(key)
+        shutil.copyfile(filename, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        self.entries.pop(key, None)
+        self.entries[key] = os.stat(path).st_size
+        self.evict()
+    
+    def evict(self):
+        total = sum(self.entries.values())
+        while total > self.max_size and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,123 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import json
+import hashlib
+from dependencies import changed
+
+# Files LaTeX and SlideDeX may leave behind for each slide.
+SUFFIXES = ('.tex', '.aux', '.log', '.out', '.nav', '.snm', '.toc', '.vrb', '.fls',
+            '.fdb_latexmk', '.dvi', '.ps', '.pdf', '.thumb.png')
+
+def digest(text):
+    return hashlib.sha1(text).hexdigest()
+
+def file_digest(filename):
+    """Return the digest of the contents of filename, or None if it can't be read."""
+    try:
+        f = file(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        return digest(f.read())
+    finally:
+        f.close()
+
+
+class BuildIndex(object):
+    """A record of how each slide of a presentation was last compiled.
+    
+    For each slide, named by its filename, this holds digests of the parts
+    of its source, the command used, the exit status, a digest of the PDF
+    produced, and the files outside the source that it read.  The
+    presentation is recorded under the name ''.  A slide is fresh, and
+    needn't be compiled again, if it compiled successfully from the same
+    source and command, and none of those files have changed since.  The
+    index is kept as JSON in the build directory, next to the files it
+    describes.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, path):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.modified = False
+        self.entries = {}
+        try:
+            f = file(path, 'r')
+        except IOError:
+            return
+        try:
+            data = json.load(f)
+        except ValueError:
+            data = {}  # Corrupt, so start afresh.
+        f.close()
+        if data.get('version') == self.VERSION:
+            self.entries = data['entries']
+    
+    def get(self, name):
+        return self.entries.get(name or '')
+    
+    def record(self, name, **fields):
+        """Replace the entry for name with fields."""
+        self.entries[name or ''] = fields
+        self.modified = True
+    
+    def invalidate(self, name):
+        """Mark name as not fresh, such as while it is being compiled."""
+        entry = self.get(name)
+        if entry is not None and entry.get('status') is not None:
+            entry['status'] = None
+            self.modified = True
+    
+    def fresh(self, name, **fields):
+        """Whether name compiled successfully with the given fields, and its
+        dependencies are unchanged.  Fields not given aren't checked."""
+        entry = self.get(name)
+        if entry is None or entry.get('status') != 0:
+            return False
+        for key, value in fields.items():
+            if entry.get(key) != value:
+                return False
+        return not changed(entry.get('deps', {}))
+    
+    def dependencies(self, name):
+        """Return the paths of the files name was found to depend on."""
+        return (self.get(name) or {}).get('deps', {}).keys()
+    
+    def remove(self, name):
+        """Forget name, and delete its files.  Those that can't be deleted are
+        left behind, as the entry is already gone."""
+        self.entries.pop(name, None)
+        self.modified = True
+        for suffix in SUFFIXES:
+            try:
+                os.unlink(os.path.join(self.dir, name + suffix))
+            except OSError:
+                pass
+    
+    def collect(self, names):
+        """Remove every slide not among names."""
+        for name in self.entries.keys():
+            if name and name not in names:
+                self.remove(name)
+    
+    def save(self):
+        if not self.modified:
+            return
+        f = file(self.path + '.tmp', 'w')
+        try:
+            json.dump(dict(version=self.VERSION, entries=self.entries), f, sort_keys=True)
+            # So a crash can't leave an empty index in place of the old one.
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(self.path + '.tmp', self.path)
+        self.modified = False
@@ -0,0 +1,84 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import csv
+import json
+import time
+
+FIELDS = ('time', 'name', 'step', 'seconds')
+# The steps that start a build; everything else is part of the build before.
+FIRST_STEPS = ('wait', 'cache')
+
+
+class BuildReport(object):
+    """Timings of each step in building the slides and presentation.
+    
+    Each record gives the time a step started, the name of what was being
+    built (the base filename of a slide or the presentation), the step, and
+    how long it took.  The steps are 'wait', for time spent in the queue,
+    'cache', for fetching a PDF from the build cache, the name of each
+    command run, 'load', for loading the PDF, and 'thumbnail'.
+    """
+    
+    def __init__(self):
+        self.records = []
+    
+    def add(self, name, step, seconds, start=None):
+        if start is None:
+            start = time.time() - seconds
+        self.records.append(dict(time=start, name=name, step=step, seconds=seconds))
+    
+    def latest(self, name):
+        """Return the records of the most recent build of name."""
+        records = []
+        for record in reversed(self.records):
+            if record['name'] == name:
+                records.insert(0, record)
+                if record['step'] in FIRST_STEPS:
+                    break
+        return records
+    
+    def build_time(self, name):
+        """The time taken by the most recent build of name, not counting waiting."""
+        return sum(r['seconds'] for r in self.latest(name) if r['step'] != 'wait')
+    
+    def summary(self, name):
+        """Describe the most recent build of name, like '1.20 s (latex 0.90 s, ...)'."""
+        return '%.2f s (%s)' % (self.build_time(name),
+                                ', '.join('%s %.2f s' % (r['step'], r['seconds'])
+                                          for r in self.latest(name)))
+    
+    def totals(self):
+        """Return a list of (seconds, name) for the time spent building each
+        name in the session, not counting waiting, from slowest to fastest."""
+        totals = {}
+        for record in self.records:
+            if record['step'] != 'wait':
+                totals[record['name']] = totals.get(record['name'], 0) + record['seconds']
+        return sorted(((t, n) for n, t in totals.items()), reverse=True)
+    
+    def write_json(self, fobj):
+        json.dump({'records': self.records,
+                   'totals': [dict(name=n, seconds=t) for t, n in self.totals()]},
+                  fobj, indent=1, sort_keys=True)
+    
+    def write_csv(self, fobj):
+        writer = csv.writer(fobj)
+        writer.writerow(FIELDS)
+        for record in self.records:
+            writer.writerow([record[f] for f in FIELDS])
+    
+    def save(self, filename):
+        """Write the report to filename, as JSON if it ends in .json, and as CSV otherwise."""
+        f = file(filename, 'w')
+        try:
+            if filename.lower().endswith('.json'):
+                self.write_json(f)
+            else:
+                self.write_csv(f)
+        finally:
+            f.close()
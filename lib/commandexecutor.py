@@ -8,52 +8,189 @@
 import gtk
 import vte
 import os
+import time
+import signal
+import multiprocessing
+from processrunner import Process, OutputBuffer
+from misc import search_path_env
 os.environ['openout_any'] = 'a'
 
 
+class Job(object):
+    """A list of commands to be run one after another in a single worker."""
+    
+    def __init__(self, commands, stop_on_error, callback, parallel, target, priority, name,
+                 before):
+        self.commands = list(commands)
+        self.stop_on_error = stop_on_error
+        self.callback = callback
+        self.parallel = parallel
+        self.target = target
+        self.priority = priority
+        self.name = name
+        self.before = before
+        self.added = time.time()
+        self.cancelled = False
+        self.worker = None
+        self.output = None
+
+
+class Worker(object):
+    """A terminal in which the commands of one job at a time are run."""
+    
+    def __init__(self, executor, index):
+        self.executor = executor
+        self.job = None
+        self.pid = None
+        self.command = None
+        self.started = None
+        self.term = vte.Terminal()
+        self.term.set_scrollback_lines(1000)
+        self.term.connect('child-exited', self.on_child_exited)
+        self.page = gtk.HBox()
+        self.page.pack_start(self.term)
+        self.page.pack_start(gtk.VScrollbar(self.term.get_adjustment()), False)
+        self.page.show_all()
+        executor.notebook.append_page(self.page, gtk.Label('Job %i' % (index + 1)))
+    
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass  # Already finished
+    
+    def start(self, job):
+        self.job = job
+        job.worker = self
+        # Each job gets a fresh terminal, so its output stays separate.
+        self.term.reset(True, True)
+    
+    def fork(self, command):
+        self.command = command
+        self.started = time.time()
+        self.term.feed('$ ' + ' '.join(command) + '\r\n')
+        self.pid = self.term.fork_command(command[0], command,
+                                          ['%s=%s' % item for item in self.executor.env.items()],
+                                          directory=self.executor.dir)
+        # Control will be picked up in executor.callback() next.
+    
+    def on_child_exited(self, term):
+        self.executor.callback(self, term.get_child_exit_status())
+    
+    def show_output(self, job):
+        pass  # Already in the terminal
+
+
+class PipeWorker(Worker):
+    """A worker that runs commands without a terminal, collecting their output
+    in job.output.  The output is only copied into the terminal to show an error."""
+    
+    def __init__(self, executor, index):
+        Worker.__init__(self, executor, index)
+        self.process = None
+    
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+    
+    def start(self, job):
+        Worker.start(self, job)
+        job.output = OutputBuffer()
+    
+    def fork(self, command):
+        self.command = command
+        self.started = time.time()
+        self.job.output.write('$ ' + ' '.join(command) + '\n')
+        self.process = Process(command, self.executor.dir, self.on_process_exited,
+                               self.job.output, self.executor.env)
+    
+    def on_process_exited(self, status, output):
+        self.process = None
+        self.executor.callback(self, status)
+    
+    def show_output(self, job):
+        self.term.feed(job.output.getvalue().replace('\n', '\r\n'))
+
+
 class CommandExecutor(object):
     
     NOOP = -1
     
-    def __init__(self, parent):
+    # Job priorities; lower numbers run first.
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    
+    def __init__(self, parent, max_jobs=None, report=None):
         self.is_running = False
         self.command_queue = []
+        self.running = []
+        self.workers = []
+        self.last_status = 0
+        self.errors = False
         self.parent = parent
+        self._max_jobs = max_jobs
+        self.report = report
+        self._following = None  # Jobs added by the callback being run
         
         self.window = gtk.Window()
         vbox = gtk.VBox()
         self.window.add(vbox)
-        hbox = gtk.HBox()
-        vbox.pack_start(hbox)
-        self.term = vte.Terminal()
-        hbox.pack_start(self.term)
-        hbox.pack_start(gtk.VScrollbar(self.term.get_adjustment()), False)
-        self.term.set_scrollback_lines(1000)
+        self.notebook = gtk.Notebook()
+        self.notebook.set_scrollable(True)
+        vbox.pack_start(self.notebook)
         
         hbox = gtk.HBox()
         vbox.pack_start(hbox, expand=False, padding=6)
         self.label = gtk.Label('Hi')
-        self.button = gtk.Button('Close')
-        self.button.connect('clicked', self.on_close)
+        self.button = gtk.Button('Stop')
+        self.button.connect('clicked', self.on_button)
         hbox.pack_start(self.label, True, False)
         hbox.pack_end(self.button, False)
         vbox.show_all()
         self.window.connect('delete-event', self.on_close)
-        self.term.connect('child-exited', self.callback)
         self.window.set_position(gtk.WIN_POS_CENTER_ON_PARENT)
         self.window.set_resizable(False)
         self.window.set_transient_for(self.parent.window)
     
     @property
     def dir(self):
-        return self.parent.dir
+        # Commands are run in the build directory, with the document's
+        # directory added to the search paths.
+        return self.parent.build_dir
+    
+    @property
+    def env(self):
+        return search_path_env(self.parent.dir)
+    
+    @property
+    def max_jobs(self):
+        """The number of jobs that may run at once.
+        
+        Unless given to the constructor, this is taken from the document
+        settings, which default to the number of cores."""
+        if self._max_jobs:
+            return self._max_jobs
+        if self.parent.settings is not None:
+            return self.parent.settings.jobs
+        return multiprocessing.cpu_count()
     
-    def add(self, commands, stop_on_error=True, callback=None):
+    @property
+    def backend(self):
+        """How commands are run: 'terminal', in a terminal shown while they run,
+        or 'pipe', without one, only showing their output if there is an error."""
+        if self.parent.settings is not None:
+            return self.parent.settings.backend
+        return 'terminal'
+    
+    def add(self, commands, stop_on_error=True, callback=None, parallel=False, target=None,
+            priority=BACKGROUND, name=None, before=None):
         """ Add specified commands to the executor, and begin running if paused.
         
         Input:  commands:       A list of commands to be run.  Each command is itself
                                 a list, corresponding to the argv of the to be run.
                                 That is, commands[i] = [program, arg1, arg2, ... ]
+                                [NOOP] runs nothing, so the job only waits its turn
+                                to run its callback.
                 
                 stop_on_error:  Whether to running this and all queued commands on
                                 reaching an error.
@@ -64,21 +201,78 @@ class CommandExecutor(object):
                                 and the rest are additional arguments.  The first
                                 argument passed to the callback function is the status,
                                 0 for success or the non-zero error code received.
+                
+                parallel:       Whether these commands are independent of the other
+                                jobs.  Parallel jobs may be run alongside each other,
+                                up to max_jobs at once.  Other jobs wait for all
+                                previous jobs to finish, and all later jobs wait for
+                                them.
+                
+                target:         What these commands build, if anything, so that the
+                                job may be cancelled with cancel().  Jobs for the same
+                                target are never run at the same time, and a job
+                                replaces any job for the same target that is still
+                                waiting, whose callback will not be run.
+                
+                priority:       INTERACTIVE or BACKGROUND.  Waiting jobs are started
+                                in order of priority, and then in the order they were
+                                added.  A job waits only for the non-parallel jobs of
+                                the same or higher priority, and interactive jobs may
+                                use one more worker than max_jobs, so they never wait
+                                behind background work.
+                
+                name:           What to call these commands in the build report, if
+                                one was given to the constructor.  The time the job
+                                waited to start and the time each command took are
+                                recorded under this name.
+                
+                before:         A function to call, without arguments, just before
+                                the first command is run.  This is the time to
+                                write the files the commands read, since a job for
+                                the same target may be reading them until then.
+        
+        Jobs added by the callback of a job that has just finished follow on
+        from it: they are started ahead of the other jobs waiting with the same
+        priority, so that callbacks added to wait for that job wait for them too.
         """
         
-        self.command_queue.append([commands, stop_on_error, callback])
+        job = Job(commands, stop_on_error, callback, parallel, target, priority, name, before)
+        old = [j for j in self.command_queue if target is not None and j.target is target]
+        if old and old[0].priority <= priority:
+            # Take the place of the waiting job, so that anything which was
+            # to wait for it still does.
+            job.priority = old[0].priority
+            self.command_queue[self.command_queue.index(old[0])] = job
+        else:
+            if old:
+                self.command_queue.remove(old[0])
+            index = len(self.command_queue)
+            while index > 0 and self.command_queue[index-1].priority > priority:
+                index -= 1
+            if self._following is not None:
+                # After the jobs added before by the same callback.
+                while index > 0 and self.command_queue[index-1].priority == priority \
+                        and self.command_queue[index-1] not in self._following:
+                    index -= 1
+                self._following.append(job)
+            self.command_queue.insert(index, job)
         if not self.is_running:
             self.is_running = True
-            self.window.show()
+            self.errors = False
+            if self.backend == 'terminal':
+                self.window.show()
             self.label.set_text('Running')
             self.window.set_title('Running')
-            self.button.set_sensitive(False)
-            self.term.reset(True, True)
-            self.run()
+            self.button.set_label('Stop')
+            self.button.set_sensitive(True)
+        self.run()
     
     def add_callback(self, callback, *args):
         """ Add a callback to the command queue without any associated commands.
         
+        The callback is run once all jobs added before it have finished, except
+        for interactive jobs added since.
+        
         Input:  callback:   The callback function.  The first argument will be the
                             status of the *previous* command run.
                 
@@ -87,47 +281,130 @@ class CommandExecutor(object):
         
         self.add([self.NOOP], stop_on_error=False, callback=(callback,) + args)
     
+    def cancel(self, target):
+        """ Cancel all jobs building target, whether waiting or running.
+        
+        Callbacks of cancelled jobs are not run.
+        """
+        
+        for job in self.command_queue[:]:
+            if job.target is target:
+                self.command_queue.remove(job)
+        for job in self.running:
+            if job.target is target:
+                job.cancelled = True
+                job.worker.kill()
+        self.run()
+    
+    def cancel_all(self):
+        """ Cancel all waiting and running jobs. """
+        
+        self.command_queue = []
+        for job in self.running:
+            job.cancelled = True
+            job.worker.kill()
+        self.run()
+    
+    def get_worker(self, job):
+        busy = len([j for j in self.running if j.priority == self.BACKGROUND])
+        if job.priority == self.BACKGROUND and busy >= self.max_jobs:
+            return None
+        cls = self.backend == 'pipe' and PipeWorker or Worker
+        for worker in self.workers[:]:
+            if worker.job is None:
+                if type(worker) is cls:
+                    return worker
+                # Left over from before the backend was changed.
+                self.notebook.remove_page(self.notebook.page_num(worker.page))
+                self.workers.remove(worker)
+        if len(self.workers) < self.max_jobs + 1:
+            worker = cls(self, len(self.workers))
+            self.workers.append(worker)
+            return worker
+        return None
+    
     def run(self):
-        try:
-            commands, stop_on_error, callback = self.command_queue[0]
-        except IndexError:
+        index = 0  # Of the first job that may start
+        while index < len(self.command_queue):
+            job = self.command_queue[index]
+            if job.parallel:
+                if [j for j in self.running if not j.parallel and j.priority <= job.priority]:
+                    break
+                if job.target is not None and [j for j in self.running if j.target is job.target]:
+                    # Wait for the previous build to finish, or die, while
+                    # the jobs behind carry on.
+                    index += 1
+                    continue
+                worker = self.get_worker(job)
+                if worker is None:
+                    break
+            elif self.running or index > 0:
+                break  # It waits for all of the jobs before it.
+            self.command_queue.pop(index)
+            if not job.commands or job.commands[0] is self.NOOP:
+                self.finish(job, self.last_status)
+                continue
+            if not job.parallel:
+                # Before it counts as running, so it can't be short of a worker.
+                worker = self.get_worker(job)
+            self.record(job, 'wait', job.added)
+            self.running.append(job)
+            if job.before is not None:
+                job.before()
+            worker.start(job)
+            worker.fork(job.commands.pop(0))
+        
+        if not self.running and not self.command_queue:
             self.is_running = False
-            self.window.hide()
-            return
-        try:
-            command = commands[0]
-            self.command_queue[0][0] = commands[1:]
-        except IndexError:
-            self.command_queue.pop(0)
-            self.run()
-        else:
-            if command is self.NOOP:
-                self.callback(self.term)
-            else:
-                pid = self.term.fork_command(command[0], command, directory=self.dir)
-                # Control will be picked up in callback() next.
-    
-    def callback(self, term):
-        status = term.get_child_exit_status()
-        commands, stop_on_error, callback = self.command_queue[0]
+            if not self.errors:
+                self.window.hide()
+    
+    def record(self, job, step, start):
+        if self.report is not None and job.name is not None:
+            self.report.add(job.name, step, time.time() - start, start)
+    
+    def callback(self, worker, status):
+        job = worker.job
+        self.last_status = status
+        self.record(job, os.path.basename(worker.command[0]), worker.started)
         
-        if status != 0 or not commands:
-            self.command_queue.pop(0)
-            if callback:
-                callback[0](status, *callback[1:])
-        if status == 0 or not stop_on_error:
-            self.run()
-        else:
-            self.error()
+        if status == 0 and job.commands and not job.cancelled:
+            worker.fork(job.commands.pop(0))
+            return
+        self.finish(job, status)
+        if status != 0 and job.stop_on_error and not job.cancelled:
+            self.error(worker, job)
+        self.run()
+    
+    def finish(self, job, status):
+        if job in self.running:
+            self.running.remove(job)
+        if job.worker is not None:
+            job.worker.job = None
+        if job.callback and not job.cancelled:
+            following, self._following = self._following, []
+            try:
+                job.callback[0](status, *job.callback[1:])
+            finally:
+                self._following = following
     
-    def error(self):
+    def error(self, worker, job):
         self.command_queue = []
-        self.is_running = False
+        self.errors = True
+        worker.show_output(job)
+        self.window.show()
         self.label.set_text('Errors')
         self.window.set_title('Errors')
-        self.button.set_sensitive(True)
+        self.notebook.set_current_page(self.notebook.page_num(worker.page))
+        self.button.set_label('Close')
         self.button.grab_focus()
     
+    def on_button(self, widget):
+        if self.errors or not self.is_running:
+            self.on_close(widget)
+        else:
+            self.cancel_all()
+    
     def on_close(self, widget, event=None):
         self.window.hide()
         return True
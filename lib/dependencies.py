@@ -0,0 +1,80 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import re
+
+# Bibliographies are read by BibTeX or Biber, not LaTeX, so they aren't
+# in the recorder's list.
+BIB_RE = re.compile(r'\\(?:bibliography|addbibresource)(?:\[[^]]*\])?\{([^}]*)\}')
+
+def stat_key(path):
+    """Return what is compared to see if path has changed: its modification time
+    and size, or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def read_recorder(filename):
+    """Return the absolute paths of the files read, as listed in the .fls file
+    written by LaTeX's -recorder option, or [] if it can't be read."""
+    try:
+        f = file(filename, 'r')
+    except IOError:
+        return []
+    paths = []
+    seen = set()
+    cwd = os.path.dirname(filename)
+    for line in f:
+        kind, sep, path = line.rstrip('\n').partition(' ')
+        if kind == 'PWD':
+            cwd = path
+        elif kind == 'INPUT':
+            path = os.path.normpath(os.path.join(cwd, path))
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    f.close()
+    return paths
+
+def bibliographies(source, docdir):
+    """Return the paths of the bibliography files named in source."""
+    paths = []
+    for match in BIB_RE.finditer(source):
+        for name in match.group(1).split(','):
+            name = name.strip()
+            if name:
+                if not os.path.splitext(name)[1]:
+                    name += '.bib'
+                paths.append(os.path.normpath(os.path.join(docdir, name)))
+    return paths
+
+def dependencies(fn, source, docdir, build_dir):
+    """Return a dict of the files under docdir that the build of fn.tex from
+    source read, giving the stat_key() of each.  The files of the build
+    itself, and other files, like those of the TeX distribution, aren't
+    tracked."""
+    docdir = os.path.realpath(docdir) + os.sep
+    build_dir = os.path.realpath(build_dir) + os.sep
+    own = os.path.realpath(fn) + '.'
+    deps = {}
+    for path in read_recorder(fn + '.fls') + bibliographies(source, docdir):
+        real = os.path.realpath(path)
+        if (real.startswith(docdir) and not real.startswith(own) and
+                (build_dir == docdir or not real.startswith(build_dir))):
+            deps[path] = stat_key(path)
+    return deps
+
+def changed(deps):
+    """Whether any of the files in deps, as returned by dependencies(), has changed."""
+    for path, key in deps.items():
+        if stat_key(path) != key:
+            return True
+    return False
+
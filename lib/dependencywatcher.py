@@ -0,0 +1,85 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import glib
+import gio
+
+
+class DependencyWatcher(object):
+    """Watches the files that slides depend on.
+    
+    Once the files have stopped changing for delay milliseconds,
+    callback(slides) is called with the set of the slides that depend on
+    any of them.
+    """
+    
+    def __init__(self, callback, delay=500):
+        self.callback = callback
+        self.delay = delay
+        self._slides = {}  # path -> set of slides
+        self._paths = {}  # slide -> set of paths
+        self._monitors = {}  # path -> gio.FileMonitor
+        self._changed = set()
+        self._timer = None
+    
+    def watch(self, slide, paths):
+        """Set the paths that slide depends on, replacing those from before."""
+        paths = set(paths)
+        old = self._paths.get(slide, set())
+        for path in old - paths:
+            self._unwatch(slide, path)
+        for path in paths - old:
+            if path not in self._slides:
+                self._slides[path] = set()
+                try:
+                    monitor = gio.File(path).monitor_file()
+                except gio.Error:
+                    pass  # Changes just won't be noticed.
+                else:
+                    monitor.connect('changed', self._on_changed, path)
+                    self._monitors[path] = monitor
+            self._slides[path].add(slide)
+        self._paths[slide] = paths
+    
+    def forget(self, slide):
+        for path in self._paths.pop(slide, ()):
+            self._unwatch(slide, path)
+    
+    def _unwatch(self, slide, path):
+        self._slides[path].discard(slide)
+        if not self._slides[path]:
+            del self._slides[path]
+            monitor = self._monitors.pop(path, None)
+            if monitor is not None:
+                monitor.cancel()
+    
+    def close(self):
+        for slide in self._paths.keys():
+            self.forget(slide)
+        if self._timer is not None:
+            glib.source_remove(self._timer)
+            self._timer = None
+    
+    def _on_changed(self, monitor, file, other_file, event, path):
+        if event not in (gio.FILE_MONITOR_EVENT_CHANGED, gio.FILE_MONITOR_EVENT_CREATED,
+                         gio.FILE_MONITOR_EVENT_DELETED):
+            return
+        self._changed.add(path)
+        # Wait for the writing to finish.
+        if self._timer is not None:
+            glib.source_remove(self._timer)
+        self._timer = glib.timeout_add(self.delay, self._notify)
+    
+    def _notify(self):
+        self._timer = None
+        slides = set()
+        for path in self._changed:
+            slides.update(self._slides.get(path, ()))
+        self._changed.clear()
+        if slides:
+            self.callback(slides)
+        return False
@@ -11,9 +11,25 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 from StringIO import StringIO
-import glib
+import os
+import tempfile
+import hashlib
+import multiprocessing
+from misc import choose_engine, needs_dvi
 
-DEFAULT_COMMAND = 'latex -halt-on-error {fn}; dvips {fn}; ps2pdf {fn}.ps'
+# The default command of older versions.
+DVI_COMMAND = 'latex -halt-on-error {fn}; dvips {fn}; ps2pdf {fn}.ps'
+# LaTeX carries on past errors, so that the log lists them all, with the
+# file and line of each.  The files read are listed in a .fls file.
+FLAGS = '-interaction=nonstopmode -file-line-error -recorder'
+# The commands for each engine, in order of preference.
+ENGINES = OrderedDict([
+    ('pdflatex', 'pdflatex %s {fn}' % FLAGS),
+    ('xelatex', 'xelatex %s {fn}' % FLAGS),
+    ('lualatex', 'lualatex %s {fn}' % FLAGS),
+    ('latexmk', 'latexmk -pdf %s {fn}' % FLAGS),
+    ('latex', 'latex %s {fn}; dvips {fn}; ps2pdf {fn}.ps' % FLAGS),
+])
 
 class SettingsError(Exception):
     pass
@@ -24,8 +40,6 @@ class DocumentSettings(object):
         self.parent = parent
         self.parser = ConfigParser.RawConfigParser(dict_type=OrderedDict)
         self.parser.add_section('commands')
-        self.parser.set('commands', 'slide', DEFAULT_COMMAND)
-        self.parser.set('commands', 'presentation', DEFAULT_COMMAND)
         self.parser.add_section('skeletons')
         self.load(input_string)
     
@@ -39,7 +53,8 @@ class DocumentSettings(object):
                     raise SettingsError, "Invalid line start"
         settings_string.seek(0)
         self.parser.readfp(settings_string)
-        glib.idle_add(self.parent.generate_skeleton_menu)
+        if self.engine != 'auto' and self.engine not in ENGINES:
+            raise SettingsError, "Unknown engine '%s'" % self.engine
     
     def write(self):
         settings_string = StringIO()
@@ -48,13 +63,163 @@ class DocumentSettings(object):
         output = ['% ' + line for line in settings_string]
         return ''.join(output)
     
+    def _get(self, getter, section, option, default):
+        # Only the [commands] and [skeletons] sections are always present,
+        # and defaults aren't written into the file.
+        if self.parser.has_option(section, option):
+            return getter(section, option)
+        return default
+    
+    @property
+    def engine(self):
+        """The engine profile, one of ENGINES, or 'auto' (the default), to pick
+        the fastest one that can compile the header."""
+        return self._get(self.parser.get, 'commands', 'engine', 'auto').strip().lower()
+    
+    def engine_for(self, header, slides=None):
+        """The engine profile for a document with this header.  slides, if
+        given, is why one of its slides needs DVI."""
+        if self.engine != 'auto':
+            return self.engine
+        if slides:
+            return 'latex'
+        return choose_engine(header, self.parent.dir)
+    
+    @property
+    def legacy_dvi(self):
+        """Whether the file has the DVI route that older versions wrote into
+        every file as the default, and no engine."""
+        return (not self.parser.has_option('commands', 'engine') and
+                DVI_COMMAND in (self._get(self.parser.get, 'commands', 'slide', None),
+                                self._get(self.parser.get, 'commands', 'presentation', None)))
+    
+    def _command(self, option, header, slides):
+        command = self._get(self.parser.get, 'commands', option, None)
+        # Files from older versions keep the DVI route, since they may rely on
+        # it, until an engine is set.  It gets the flags of the latex profile.
+        if command == DVI_COMMAND:
+            if self.legacy_dvi:
+                return ENGINES['latex']
+        elif command:
+            return command
+        return ENGINES[self.engine_for(header, slides)]
+    
+    def slide_command(self, header, slides=None):
+        """The command for slides in a document with this header, and slides as
+        for engine_for(): the slide command in the settings, if any, or that of
+        the engine."""
+        return self._command('slide', header, slides)
+    
+    def pres_command(self, header, slides=None):
+        """The command for the whole presentation, as for slide_command()."""
+        return self._command('presentation', header, slides)
+    
+    def dvi_warning(self, header, slides=None):
+        """Return a warning if a document with this header, and slides as for
+        engine_for(), is compiled through DVI and PostScript without that
+        having been chosen, or else None."""
+        if self.legacy_dvi:
+            return ("The settings have the DVI commands that older versions wrote into "
+                    "every file, so slides are still compiled through DVI and PostScript.  "
+                    "Set engine = auto in the [commands] settings to use the fastest engine "
+                    "that can, or engine = latex to hide this warning.")
+        if self.engine != 'auto':
+            return None
+        reason = needs_dvi(header, self.parent.dir)
+        if reason:
+            where = 'The header'
+        elif slides:
+            where, reason = 'A slide', slides
+        else:
+            return None
+        return ("%s uses %s, so slides must be compiled through DVI and PostScript.  "
+                "Set engine = latex in the [commands] settings to hide this warning."
+                % (where, reason))
+    
+    @property
+    def merge_command(self):
+        """The program, and options, used to join PDFs.  The input files and then
+        the output file are appended to it."""
+        return self._get(self.parser.get, 'commands', 'merge', 'pdfunite')
+    
+    @property
+    def split_command(self):
+        """The program used to take pages out of a PDF.  It is given the options
+        -f FIRST -l LAST, the input file, and the output file, which contains %d
+        if there are several pages, as pdfseparate is."""
+        return self._get(self.parser.get, 'commands', 'split', 'pdfseparate')
+    
+    @property
+    def assemble(self):
+        """When to build the presentation by joining the PDFs of the slides, rather
+        than running LaTeX on it: 'always', 'never', or 'auto' (the default), when
+        nothing depends on state shared between slides, like frame numbers.
+        Of the themes, only the built-in ones showing frame numbers are known
+        to, so presentations with other themes that show them, or navigation
+        listing the other slides, need 'never'."""
+        return self._get(self.parser.get, 'build', 'assemble', 'auto').strip().lower()
+    
+    @property
+    def jobs(self):
+        """The number of slides to compile at once.  Defaults to the number of cores."""
+        return self._get(self.parser.getint, 'build', 'jobs', multiprocessing.cpu_count())
+    
+    @property
+    def batch_size(self):
+        """The most slides to compile together in one run of LaTeX, when several
+        need compiling.  1, the default, compiles each slide on its own."""
+        return max(self._get(self.parser.getint, 'build', 'batch_size', 1), 1)
+    
+    @property
+    def backend(self):
+        """How to run commands: 'terminal' (the default), in a terminal window, or
+        'pipe', without one, showing their output only if there is an error."""
+        return self._get(self.parser.get, 'build', 'backend', 'terminal').strip().lower()
+    
+    def build_dir(self, docdir):
+        """The directory in which to compile the slides of a document in docdir.
+        
+        By default, this is a directory under $XDG_RUNTIME_DIR, which is
+        normally kept in memory, or else under the temporary directory.  A
+        relative path in the settings is taken from docdir, so '.' compiles
+        next to the document."""
+        path = self._get(self.parser.get, 'build', 'directory', '').strip()
+        if path:
+            return os.path.normpath(os.path.join(docdir, os.path.expanduser(path)))
+        root = os.environ.get('XDG_RUNTIME_DIR')
+        if root:
+            root = os.path.join(root, 'slidedex')
+        else:
+            root = os.path.join(tempfile.gettempdir(), 'slidedex-%i' % os.getuid())
+        return os.path.join(root, hashlib.sha1(docdir).hexdigest()[:16])
+    
+    @property
+    def precompile(self):
+        """Whether to dump the header into a format file for slide builds."""
+        return self._get(self.parser.getboolean, 'build', 'precompile', False)
+    
+    @property
+    def subset_header(self):
+        """Whether to compile each slide with only the blocks of the header it
+        names in its '% needs:' lines."""
+        return self._get(self.parser.getboolean, 'build', 'subset_header', False)
+    
+    @property
+    def cache_size(self):
+        """The size limit of the slide build cache, in bytes.  Zero disables it."""
+        return self._get(self.parser.getint, 'build', 'cache_size', 200) * 1024 * 1024
+    
     @property
-    def slide_command(self):
-        return self.parser.get('commands', 'slide')
+    def release_after(self):
+        """Seconds after which the buffer of an unselected slide is released.  Zero
+        (the default) keeps buffers, and their undo history, forever."""
+        return self._get(self.parser.getint, 'editor', 'release_after', 0)
     
     @property
-    def pres_command(self):
-        return self.parser.get('commands', 'presentation')
+    def live_delay(self):
+        """Milliseconds without edits before the slide is compiled, when compiling
+        while typing."""
+        return self._get(self.parser.getint, 'editor', 'live_delay', 1000)
     
     @property
     def skeletons(self):
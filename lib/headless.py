@@ -0,0 +1,446 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import optparse
+import Queue
+import ConfigParser
+from StringIO import StringIO
+from misc import parse_document, format_commands, base_filename, needs_dvi, search_path_env, \
+                 format_segment, write_document
+from pipeline import slide_parts, slide_source, slide_key, slide_digests, slide_filename, \
+                     can_assemble, format_engine, format_source, format_name, format_command, \
+                     slide_commands, can_batch, batch_source, split_commands, remove_batch
+from documentsettings import DocumentSettings, SettingsError
+from buildcache import BuildCache
+from buildreport import BuildReport
+from buildindex import BuildIndex, digest, file_digest
+from latexlog import read_log, read_marks, locate, segment_starts
+from dependencies import dependencies
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class BuildJob(object):
+    
+    def __init__(self, name, fn, commands, key=None):
+        self.name = name
+        self.fn = fn
+        self.commands = commands
+        self.key = key
+        self.source = ''
+        self.deps = {}
+        self.digests = {}
+        self.fresh = False
+        self.segments = None  # For a slide, the segments of the document in its source
+        self.parts = None  # For a slide, what it is compiled from
+        self.slides = None  # For a batch, the jobs of its slides
+        self.batched = False
+        self.assembled = False  # Joined from the PDFs of the slides, without LaTeX
+        self.status = None
+        self.time = 0
+        self.cached = False
+        self.output = ''
+
+
+class HeadlessDocument(object):
+    """A presentation loaded and built without GTK, VTE, or Poppler.
+    
+    This takes the same steps as LatexDocument, from the pipeline module,
+    so that presentations can be built in batch jobs."""
+    
+    def __init__(self, filename):
+        self._dir = os.path.dirname(os.path.abspath(filename))
+        self._filename = os.path.basename(filename)
+        f = file(self.fullfilename, 'r')
+        text = f.read()
+        f.close()
+        self.text = text
+        self.digest = digest(text)
+        self.starts = segment_starts(text)
+        settings, self.header, self.slides, self.footer = parse_document(StringIO(text))
+        self.settings = DocumentSettings(self, settings)
+        self.dvi_slides = needs_dvi(''.join(content for filename, content in self.slides)
+                                    + self.footer, self.dir)
+        self._cache = None
+        self._index = None
+        self.report = BuildReport()
+    
+    @property
+    def dir(self):
+        return self._dir
+    
+    @property
+    def fullfilename(self):
+        return os.path.join(self.dir, self._filename)
+    
+    @property
+    def build_dir(self):
+        build_dir = self.settings.build_dir(self.dir)
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir, 0700)
+        return build_dir
+    
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = BuildCache(os.path.join(self.build_dir, '.slidedex-cache'),
+                                     self.settings.cache_size)
+        return self._cache
+    
+    @property
+    def build_index(self):
+        if self._index is None:
+            self._index = BuildIndex(os.path.join(self.build_dir, '.' + self._filename + '.index'))
+        return self._index
+    
+    def write(self, fobj):
+        """Write the presentation to fobj, as the editor would save it."""
+        segments = [format_segment('', self.header)]
+        segments.extend(format_segment(filename, content) for filename, content in self.slides)
+        segments.append(format_segment('', self.footer))
+        write_document(fobj, self.settings.write(), segments)
+    
+    def serialize(self):
+        """Return the presentation, as the editor would save it."""
+        fobj = StringIO()
+        self.write(fobj)
+        return fobj.getvalue()
+    
+    def slide_jobs(self, command):
+        """Write out the source for each slide and return the jobs to compile them
+        with command.  Slides that the build index shows to be up to date get
+        jobs marked fresh."""
+        taken = set(filename for filename, content in self.slides if filename)
+        jobs = []
+        for i, (filename, content) in enumerate(self.slides):
+            if not filename:
+                # A slide that has never been compiled in the editor.  It's
+                # named by its content, so the next build finds it.
+                filename = slide_filename(content, taken)
+                taken.add(filename)
+            parts = slide_parts(self.header, content, self.footer, self.settings.subset_header)
+            fn = os.path.join(self.build_dir, filename)
+            key = None
+            if self.settings.cache_size:
+                key = slide_key(parts, command)
+            job = BuildJob('%i/%i' % (i + 1, len(self.slides)), fn,
+                           format_commands(command, fn), key)
+            job.parts = parts
+            job.digests = slide_digests(parts, command)
+            job.source = slide_source(parts, filename)
+            job.fresh = self.build_index.fresh(filename, **job.digests)
+            # The document starts with the settings, then the header.
+            job.segments = [1, i + 2, len(self.slides) + 2]
+            if not job.fresh:
+                f = file(fn + '.tex', 'w')
+                f.write(job.source)
+                f.close()
+            jobs.append(job)
+        return jobs
+    
+    def header_format(self, command):
+        """Dump a format with the header preloaded, unless it exists already, and
+        return its name.  Returns None if slides compiled with command can't use
+        one, or the dump fails."""
+        if not self.settings.precompile:
+            return None
+        engine = format_engine(command, self.header, self.settings.subset_header)
+        if engine is None:
+            return None
+        source = format_source(self.header, self.footer)
+        name = format_name(engine, source)
+        fn = os.path.join(self.build_dir, name)
+        if not os.path.exists(fn + '.fmt'):
+            f = file(fn + '.tex', 'w')
+            f.write(source)
+            f.close()
+            job = BuildJob('header', fn, [format_command(engine, name)])
+            self.run_job(job)
+            if job.status != 0:
+                return None
+        return name
+    
+    def batch_jobs(self, jobs, command, format=None):
+        """Return the jobs to run in place of jobs, with slides that share a header
+        put in batches of up to batch_size, compiled with command and format.
+        Slides that can_batch() rules out are left on their own."""
+        size = self.settings.batch_size
+        if size <= 1:
+            return jobs
+        groups = OrderedDict()
+        result = []
+        for job in jobs:
+            if can_batch(job.parts):
+                groups.setdefault(job.parts[0], []).append(job)
+            else:
+                result.append(job)
+        for group in groups.values():
+            for i in range(0, len(group), size):
+                if len(group[i:i+size]) == 1:
+                    result.append(group[i])
+                    continue
+                fn = os.path.join(self.build_dir, '.slidedex-batch%i' % (len(result) + 1))
+                batch = BuildJob('batch', fn, slide_commands(command, fn, format))
+                batch.slides = group[i:i+size]
+                batch.source = batch_source([job.parts for job in batch.slides])
+                f = file(fn + '.tex', 'w')
+                f.write(batch.source)
+                f.close()
+                result.append(batch)
+        return result
+    
+    def can_assemble(self):
+        """Whether the presentation may be built by joining the PDFs of the slides."""
+        return can_assemble(self.settings.assemble, self.header,
+                            [content for filename, content in self.slides], self.footer)
+    
+    def run_commands(self, name, commands, output):
+        """Run commands, the argvs of the job name, until one fails, writing their
+        output to the file output.  Returns the status of the last one run."""
+        status = 0
+        for argv in commands:
+            step = time.time()
+            try:
+                status = subprocess.call(argv, cwd=self.build_dir, stdout=output,
+                                         stderr=subprocess.STDOUT,
+                                         env=dict(os.environ, **search_path_env(self.dir)))
+            except OSError, e:
+                output.write('%s: %s\n' % (argv[0], e.strerror))
+                status = 127
+            self.report.add(name, os.path.basename(argv[0]), time.time() - step, step)
+            if status != 0:
+                break
+        return status
+    
+    def run_job(self, job, queued=None):
+        start = time.time()
+        name = os.path.basename(job.fn)
+        if queued is not None:
+            self.report.add(name, 'wait', start - queued, queued)
+        if job.fresh:
+            job.status = 0
+        elif job.key is not None and self.cache.fetch(job.key, job.fn + '.pdf'):
+            job.cached = True
+            job.status = 0
+            self.report.add(name, 'cache', time.time() - start, start)
+        else:
+            output = tempfile.TemporaryFile()
+            job.status = self.run_commands(name, job.commands, output)
+            job.deps = dependencies(job.fn, job.source, self.dir, self.build_dir)
+            # Builds that read other files can't be reused by their source alone.
+            if job.status == 0 and job.key is not None and not job.deps:
+                self.cache.store(job.key, job.fn + '.pdf')
+            elif job.status != 0:
+                output.seek(0)
+                job.output = output.read()
+            output.close()
+        job.time = time.time() - start
+    
+    def run_batch(self, batch, queued=None):
+        """Run the job compiling a batch of slides, and split its PDF into one for
+        each.  Returns the jobs of the slides that must be compiled one by one
+        instead, since the batch failed."""
+        self.run_job(batch, queued)
+        start = time.time()
+        marks = batch.status == 0 and read_marks(batch.fn + '.log') or []
+        commands = split_commands(marks, len(batch.slides), batch.fn,
+                                  self.settings.split_command, self.settings.merge_command)
+        status = 1
+        if commands is not None:
+            output = tempfile.TemporaryFile()
+            status = self.run_commands(os.path.basename(batch.fn), commands, output)
+            output.close()
+        if status == 0:
+            for i, job in enumerate(batch.slides):
+                shutil.move('%s-%i.pdf' % (batch.fn, i), job.fn + '.pdf')
+                job.status = 0
+                job.deps = batch.deps
+                job.time = batch.time + time.time() - start
+                job.batched = True
+        remove_batch(batch.fn)
+        return status != 0 and batch.slides or []
+    
+    def run_jobs(self, jobs, njobs, report):
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        queued = time.time()
+        lock = threading.Lock()
+        
+        def worker():
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if job.slides is None:
+                    self.run_job(job, queued)
+                    with lock:
+                        report(job)
+                    continue
+                retry = self.run_batch(job, queued)
+                for slide in retry:
+                    queue.put(slide)
+                with lock:
+                    for slide in job.slides:
+                        if slide not in retry:
+                            report(slide)
+        
+        threads = [threading.Thread(target=worker) for i in range(min(njobs, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    
+    def diagnostics(self, job):
+        """Return the Diagnostics from the log of the failed job, with the lines in
+        slides counted from the start of the document, or None without a log."""
+        if job.segments is None:
+            if job.assembled:
+                return None  # There's no log.
+            # A copy of the document, so the lines are already right.
+            return read_log(job.fn + '.log')
+        diagnostics = read_log(job.fn + '.log')
+        if diagnostics is None:
+            return None
+        f = file(job.fn + '.tex', 'r')
+        source = f.read()
+        f.close()
+        for d in locate(diagnostics, source, job.fn + '.tex'):
+            if d.segment is not None:
+                d.line += self.starts[job.segments[d.segment]]
+                d.filename = None
+                d.segment = None
+        return diagnostics
+    
+    def build_presentation(self, jobs):
+        """Build the presentation, once the slides have been built by jobs, and
+        return the job that did it."""
+        index = self.build_index
+        fn = base_filename(self.fullfilename)
+        if self.can_assemble():
+            command = self.settings.merge_command
+            pdfs = [job.fn + '.pdf' for job in jobs]
+            pres = BuildJob('assembled', fn, [command.split() + pdfs + [fn + '.pdf']])
+            pres.assembled = True
+        else:
+            # Compile a copy in the build directory, and move just the PDF back.
+            command = self.settings.pres_command(self.header, self.dvi_slides)
+            buildfn = os.path.join(self.build_dir, os.path.basename(fn))
+            pres = BuildJob('document', buildfn, format_commands(command, buildfn))
+            pres.source = self.text
+        pres.fresh = (index.fresh(None, source=self.digest) and os.path.exists(fn + '.pdf')
+                      and not [job for job in jobs if not job.fresh])
+        if pres.fresh:
+            pres.status = 0
+            return pres
+        index.invalidate(None)
+        if pres.fn != fn:
+            shutil.copyfile(self.fullfilename, os.path.join(self.build_dir, self._filename))
+        self.run_job(pres)
+        if pres.status == 0 and pres.fn != fn:
+            shutil.move(pres.fn + '.pdf', fn + '.pdf')
+        index.record(None, status=pres.status, command=command, source=self.digest,
+                     deps=pres.fn != fn and pres.deps or {})
+        return pres
+    
+    def build(self, njobs=None, out=sys.stdout):
+        """Compile all slides, and then the presentation.  Returns the exit status."""
+        
+        def report(job):
+            if job.status != 0:
+                result = 'FAILED (status %i)' % job.status
+            elif job.fresh:
+                result = 'up to date'
+            elif job.cached:
+                result = 'cached'
+            elif job.batched:
+                result = 'ok (batched)'
+            else:
+                result = 'ok'
+            out.write('%-10s %-20s %7.2fs  %s\n' % (job.name, os.path.basename(job.fn),
+                                                    job.time, result))
+            out.flush()
+        
+        warning = self.settings.dvi_warning(self.header, self.dvi_slides)
+        if warning:
+            sys.stderr.write('Warning: %s\n' % warning)
+        start = time.time()
+        command = self.settings.slide_command(self.header, self.dvi_slides)
+        jobs = self.slide_jobs(command)
+        done, pending = [], []
+        for job in jobs:
+            if job.fresh or (job.key is not None and job.key in self.cache.entries):
+                done.append(job)
+            else:
+                pending.append(job)
+        format = pending and self.header_format(command) or None
+        for job in pending:
+            job.commands = slide_commands(command, job.fn, format)
+        self.run_jobs(done + self.batch_jobs(pending, command, format),
+                      njobs or self.settings.jobs, report)
+        index = self.build_index
+        for job in jobs:
+            if not job.fresh:
+                output = job.status == 0 and file_digest(job.fn + '.pdf') or None
+                index.record(os.path.basename(job.fn), status=job.status, output=output,
+                             deps=job.deps, **job.digests)
+        index.collect(set(os.path.basename(job.fn) for job in jobs))
+        if [job for job in jobs if job.status != 0]:
+            # Like the editor, don't build the presentation, which would
+            # fail as well, but report the slides at fault.
+            out.write('Not building the presentation, since slides failed\n')
+        else:
+            pres = self.build_presentation(jobs)
+            report(pres)
+            jobs.append(pres)
+        index.save()
+        
+        failed = [job for job in jobs if job.status != 0]
+        for job in failed:
+            sys.stderr.write('\n==> Output for %s (%s) <==\n' % (job.name, os.path.basename(job.fn)))
+            # First the problems, as file:line: messages, and then all of the output.
+            for d in self.diagnostics(job) or []:
+                where = d.filename and os.path.basename(d.filename) or self._filename
+                if d.line is not None:
+                    where += ':%i' % d.line
+                sys.stderr.write('%s: %s: %s\n' % (where, d.kind, d.message))
+            sys.stderr.write(job.output)
+        out.write('Built %i slides in %.2fs, %i failed\n' % (len(self.slides),
+                                                            time.time() - start, len(failed)))
+        return failed and 1 or 0
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog build [options] FILE")
+    parser.add_option('-j', '--jobs', type='int',
+                      help="number of slides to compile at once "
+                           "(default: from the document settings, or the number of cores)")
+    parser.add_option('--report', metavar='FILE',
+                      help="write the time taken by each step to FILE, "
+                           "as JSON if it ends in .json and as CSV otherwise")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected a single file to build")
+    try:
+        doc = HeadlessDocument(args[0])
+    except (IOError, SettingsError, ConfigParser.Error), e:
+        sys.stderr.write('%s: %s\n' % (args[0], e))
+        return 2
+    status = doc.build(options.jobs)
+    if options.report:
+        doc.report.save(options.report)
+    return status
@@ -7,17 +7,36 @@
 
 import os
 import sys
+import time
+import shutil
+from StringIO import StringIO
 import gtk
 import glib
 import pango
 import poppler
 import gtkspell
 import gtksourceview2 as sourceview
-from misc import SEP, LIBPATH, base_filename
+from misc import SEP, LIBPATH, base_filename, iter_segments, format_commands, needs_dvi, \
+                 write_document, replace_file
+from pipeline import slide_key, can_assemble, format_engine, format_source, format_name, \
+                     format_command, slide_commands, can_batch, batch_source, split_commands, \
+                     remove_batch
 from pdfviewer import PDFViewer
 from latexslide import LatexSlide, HeaderFooter
 from commandexecutor import CommandExecutor
+from buildcache import BuildCache
+from buildreport import BuildReport
+from buildindex import BuildIndex, digest
+from latexlog import Diagnostic, read_log, read_marks, locate
+from dependencies import dependencies
+from dependencywatcher import DependencyWatcher
+from slidelist import SlideList
+from thumbnailer import Thumbnailer
 from documentsettings import DocumentSettings
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 
 class ObstinateUserError(Exception):
@@ -40,6 +59,7 @@ class LatexDocument(object):
     
     SAME_WIDGET = 1000
     TEXT = 1001
+    LOAD_BATCH = 20  # Slides added per idle callback while loading
     TARGETS = [('SLIDEDEX_SLIDE', gtk.TARGET_SAME_WIDGET, SAME_WIDGET),
                ('text/plain', 0, TEXT)]
     
@@ -53,7 +73,19 @@ class LatexDocument(object):
         vbox.pack_end(toolbar, False)
         vbox.pack_end(menu, False)
         hbox.pack_end(slidebar, False)
+        self.statusbar = gtk.Statusbar()
+        vbox.pack_end(self.statusbar, False)
+        vbox.reorder_child(self.statusbar, 0)  # Below everything else
+        self.statusbar.show()
+        self._timing_context = self.statusbar.get_context_id('timing')
+        self._error_context = self.statusbar.get_context_id('error')
+        self.diagnostics = []  # From the last failed build of the presentation
         self.viewer = PDFViewer(builder)
+        # Timings of everything built this session.
+        self.report = BuildReport()
+        self.thumbnailer = Thumbnailer(self.report)
+        # Rebuilds slides when the files they read change.
+        self.watcher = DependencyWatcher(self.on_dependencies_changed)
         builder.connect_signals(EventDispatcher(self))
         
         self.settings = None
@@ -78,6 +110,9 @@ class LatexDocument(object):
             view.show()
         self.notebook.set_current_page(1)
 
+        # The ListStore only mirrors self.slides, for the benefit of the slide list.
+        self.slides = SlideList()
+        self.slides.connect(self.on_slides_changed)
         self.pages = gtk.ListStore(object, gtk.gdk.Pixbuf)
         self.pages.connect('row-inserted', self.on_row_inserted)
         self.pages.connect('row-deleted', self.on_row_deleted)
@@ -92,16 +127,29 @@ class LatexDocument(object):
                                                    gtk.gdk.ACTION_MOVE | gtk.gdk.ACTION_COPY)
         self.slidelist_view.connect('drag-data-get', self.on_drag_data_get)
         self.slidelist_view.connect('drag-data-received', self.on_drag_data_received)
+        self.slidelist_view.connect('drag-data-delete', self.on_drag_data_delete)
         
         self._filename = None
         self._dir = None
         self.doc = None
+        self._dvi_slides = None  # Why the slides need DVI, if they do
         self._loaded = True
+        self._loader = None
+        self._shown_slide = None
+        self._live = False
+        self._live_timer = None
         self._order_modified = False
+        self._format = None
+        self._format_pending = None
+        self._failed_formats = set()
+        self._cache = None
+        self._index = None
+        self._index_timer = None
+        self._batches = 0  # Batches of slides compiled, to name them
         if filename is not None:
             glib.idle_add(self.load, filename)
         
-        self.executor = CommandExecutor(self)
+        self.executor = CommandExecutor(self, report=self.report)
         
         self.window.show()
         gtk.main()
@@ -118,69 +166,154 @@ class LatexDocument(object):
     def fullfilename(self):
         return os.path.join(self.dir, self._filename)
     
+    @property
+    def build_dir(self):
+        """Where slides, and the presentation, are compiled.  Only the PDF of the
+        presentation is put next to the document."""
+        build_dir = self.settings.build_dir(self.dir)
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir, 0700)
+        return build_dir
+    
     @fullfilename.setter
     def fullfilename(self, filename):
         self._dir = os.path.dirname(os.path.abspath(filename))
         self._filename = os.path.basename(filename)
     
+    @property
+    def slide_command(self):
+        return self.settings.slide_command(self.header.get_content(raw=True), self._dvi_slides)
+    
+    @property
+    def pres_command(self):
+        return self.settings.pres_command(self.header.get_content(raw=True), self._dvi_slides)
+    
+    def check_dvi(self, content):
+        """Note if content, of a slide, needs DVI.  Once one does, every slide
+        is compiled through DVI, until the file is loaded again."""
+        if self._dvi_slides is None:
+            self._dvi_slides = needs_dvi(content, self.dir)
+            if self._dvi_slides and self._loaded:
+                glib.idle_add(self.warn_dvi)
+    
     def load(self, filename):
         self.fullfilename = filename
         f = file(self.fullfilename, 'r')
         self._load(f)
     
     def _load(self, fobj):
+        # The slides are added in batches from idle callbacks, so the first
+        # ones may be edited while the rest of the file is being read.
         self._loaded = False
-        if not fobj.readline().startswith(SEP):
-            raise IOError, "Not a SlideDeX file"
-        str = fobj.read()
-        segments = str.split(SEP)
-        if len(segments) < 3:
+        self._order_modified = False
+        segments = iter_segments(fobj)
+        try:
+            settings = segments.next()[1]
+            header = segments.next()[1]
+            pending = segments.next()
+        except StopIteration:
             raise IOError, "Could not load from file"
-        self.settings = DocumentSettings(self, segments[0])
-        self.pages.clear()
-        self.header.set_content(segments[1][1:])  # Ignore empty line for filename
-        self.footer.set_content(segments[-1][1:])
-        for s in segments[2:-1]:
-            filename, content = s.split('\n', 1)
-            self.add_page(content, filename)
+        self.settings = DocumentSettings(self, settings)
+        self._dvi_slides = None
+        glib.idle_add(self.generate_skeleton_menu)
+        self.slides.clear()
+        self.header.set_content(header)
+        self.footer.set_content("")
+        self.header.modified_since_save = False
+        self.footer.modified_since_save = False
+        
+        self._loader = (segments, pending)
+        if self._load_batch():
+            glib.idle_add(self._load_batch)
+        if len(self.slides):
+            self.slidelist_view.select_path((0,))
+    
+    def _load_batch(self, size=LOAD_BATCH):
+        """Add up to size (or all, if None) of the remaining slides from the file
+        being loaded.  Returns whether there are more to come."""
+        if self._loader is None:
+            return False
+        segments, pending = self._loader
+        for segment in segments:
+            # We can't tell the footer from a slide until we reach the end.
+            filename, content = pending
+            self.check_dvi(content)
+            self.add_page(content, filename, modified=False)
+            pending = segment
+            if size is not None:
+                size -= 1
+                if size <= 0:
+                    self._loader = (segments, pending)
+                    return True
         
+        self._loader = None
+        self.footer.set_content(pending[1])
+        index = self.build_index
+        footer = digest(self.footer.get_content())
+        for p in self.slides:
+            if not p.modified_since_compile and not index.fresh(p._filename, footer=footer):
+                p.modified_since_compile = True
+        # Clear out slides deleted since the index was last saved.
+        index.collect(set(p._filename for p in self.slides))
         pdffn = base_filename(self.fullfilename) + '.pdf'
-        select_first_page = lambda status: self.slidelist_view.select_path((0,))
-        if os.path.exists(pdffn) and os.stat(pdffn).st_mtime >= os.stat(self.fullfilename).st_mtime:
+        if index.fresh(None, source=digest(self.serialize())) and os.path.exists(pdffn):
             self.compile_pages()
             self.doc = poppler.document_new_from_file('file://' + os.path.abspath(pdffn), None)
-            self.executor.add_callback(select_first_page)
         else:
-            self.compile(select_first_page)
-        self.modified = False  # Set modified_since_save, and update the window title
+            self.compile()
+        # Show the newly compiled version of the current slide.
+        self.executor.add_callback(lambda status: self.on_selection_changed(self.slidelist_view))
         self._loaded = True
+        self.on_modified_changed()
+        glib.idle_add(self.warn_dvi)
+        return False
     
-    def add_page(self, content="", filename="", after=None, before=None, render=False):
-        slide = LatexSlide(self, content, filename, render=(render and content))
-        if after is not None:
-            self.pages.insert_after(after, (slide, slide.pb))
-        elif before is not None:
-            self.pages.insert_before(before, (slide, slide.pb))
-        else:
-            self.pages.append((slide, slide.pb))
+    def finish_loading(self):
+        """Add any slides that have not yet been loaded from the file."""
+        self._load_batch(None)
+    
+    def add_page(self, content="", filename="", index=None, render=False, modified=True):
+        """Add a new slide at index, or at the end if index is None."""
+        slide = LatexSlide(self, content, filename, render=(render and content), modified=modified)
+        self.slides.insert(index, slide)
+    
+    def delete_page(self, index):
+        slide = self.slides.remove(index)
+        slide.cancel_release()
+        self.watcher.forget(slide)
+        if slide._filename:
+            self.build_index.remove(slide._filename)
     
-    def delete_page(self, iter):
-        slide, = self.pages.get(iter, 0)
-        slide.del_files()
-        self.pages.remove(iter)
+    def on_slides_changed(self, event, *args):
+        if event == 'inserted':
+            index, slide = args
+            self.pages.insert(index, (slide, slide.pb))
+        elif event == 'deleted':
+            self.pages.remove(self.pages.get_iter((args[0],)))
+        elif event == 'reordered':
+            self.pages.reorder(args[0])
+        elif event == 'changed':
+            index, slide = args
+            self.pages[index][1] = slide.pb
+        elif event == 'cleared':
+            self.pages.clear()
+    
+    def serialize(self):
+        """Return the presentation, as it would be saved."""
+        fobj = StringIO()
+        self._save(fobj)
+        return fobj.getvalue()
     
     def _save(self, fobj):
-        fobj.write(SEP + '\n')
-        fobj.write(self.settings.write())
-        fobj.write(self.header.get_content())
-        for p in self.pages:
-            fobj.write(p[0].get_content())
-        fobj.write(self.footer.get_content())
+        segments = [self.header.save_content()]
+        segments.extend(p.save_content() for p in self.slides)
+        segments.append(self.footer.save_content())
+        write_document(fobj, self.settings.write(), segments)
     
     def save(self):
-        f = file(self.fullfilename, 'w')
-        self._save(f)
-        f.close()
+        """Save the presentation, as replace_file() does."""
+        self.finish_loading()
+        replace_file(self.fullfilename, self._save)
         self.modified = False
     
     @property
@@ -192,8 +325,8 @@ class LatexDocument(object):
             # may not have their LatexSlides yet, so we want to short-
             # circuit here.
             return True
-        for p in self.pages:
-            if p[0].modified_since_save:
+        for p in self.slides:
+            if p.modified_since_save:
                 return True
         return False
     
@@ -205,8 +338,10 @@ class LatexDocument(object):
             return
         self.header.modified_since_save = mod
         self.footer.modified_since_save = mod
-        for p in self.pages:
-            p[0].modified_since_save = mod
+        for p in self.slides:
+            # Each change updates the title, so only make those needed.
+            if p.modified_since_save:
+                p.modified_since_save = mod
     
     def on_modified_changed(self):
         name = self._filename or "Unnamed Presentation"
@@ -215,35 +350,435 @@ class LatexDocument(object):
         else:
             self.window.set_title(name)
     
-    def compile_pages(self):
-        for p,_ in self.pages:
-            if p.modified_since_compile:
-                def pagecallback(status, page=p):  # Freeze p
-                    if status == 0:
-                        page.render_thumb()
-                p.compile(pagecallback, False)
+    def compile_pages(self, failed=None):
+        """Compile every slide modified since it was last compiled.  Those that
+        fail are added to the list failed, if given."""
+        self.finish_loading()
+        def pagecallback(status, page):
+            if status == 0:
+                page.render_thumb()
+            else:
+                page.modified_since_compile = True  # Try again next time
+                if failed is not None:
+                    failed.append(page)
+        
+        pages = [p for p in self.slides if p.modified_since_compile]
+        for p in pages:
+            self.check_dvi(p.get_content(raw=True))
+        size = self.settings.batch_size
+        if size > 1 and len(pages) > 1:
+            # Slides are batched with others of the same header, unless their
+            # PDFs are in the cache already, or they can't be.
+            batches = OrderedDict()
+            for p in pages:
+                parts = p.compile_parts()
+                key = self.cache_key(parts, self.slide_command)
+                if (key is not None and key in self.cache.entries) or not can_batch(parts):
+                    continue
+                batches.setdefault(parts[0], []).append(p)
+            for batch in batches.values():
+                for i in range(0, len(batch), size):
+                    if len(batch[i:i+size]) > 1:
+                        self.compile_batch(batch[i:i+size], pagecallback)
+        for p in pages:
+            if p.modified_since_compile:  # Not in a batch
+                p.compile(lambda status, page=p: pagecallback(status, page), False)
     
     def compile(self, callback=None, stop_on_error=True):
-        self.compile_pages()
+        failed = []
+        self.compile_pages(failed)
         if self.modified:
             self.save()
-        self.do_latex(callback, stop_on_error)
+        # Decide once the slides are done, in case some of them failed.
+        self.executor.add_callback(self._after_pages, failed, callback, stop_on_error)
     
     def do_latex(self, callback, stop_on_error):
-        self._do_latex(self, self.settings.pres_command, callback, stop_on_error)
-    
-    def _do_latex(self, obj, command, callback, stop_on_error):
-        # obj is either this LatexDocument or one of its LatexSlides
-        fn = base_filename(obj.fullfilename)
+        text = self.serialize()
+        source = digest(text)
+        command = self.pres_command
         
         def after_latex(status):
+            fn = os.path.join(self.build_dir, os.path.basename(base_filename(self.fullfilename)))
+            self.record_build(None, status=status, command=command, source=source,
+                              deps=dependencies(fn, text, self.dir, self.build_dir))
+            if callback:
+                callback(status)
+        
+        self.build_index.invalidate(None)
+        self._do_latex(self, command, after_latex, stop_on_error)
+    
+    def can_assemble(self):
+        """Whether the presentation may be built by joining the PDFs of the slides."""
+        return can_assemble(self.settings.assemble, self.header.get_content(raw=True),
+                            [p.get_content(raw=True) for p in self.slides],
+                            self.footer.get_content(raw=True))
+    
+    def _after_pages(self, status, failed, callback, stop_on_error):
+        if failed:
+            # The presentation would fail as well, so report them all now.
+            failed.sort(key=self.slides.index)
+            self.report_failures(failed)
+            if callback:
+                callback(1)
+        elif self.can_assemble():
+            self.assemble(callback, stop_on_error)
+        else:
+            self.do_latex(callback, stop_on_error)
+    
+    def assemble(self, callback=None, stop_on_error=True):
+        """Build the presentation by joining the PDFs of the compiled slides."""
+        fn = base_filename(self.fullfilename)
+        pdfs = [base_filename(p.fullfilename) + '.pdf' for p in self.slides]
+        
+        name = os.path.basename(fn)
+        source = digest(self.serialize())
+        command = self.settings.merge_command
+        
+        def after_assemble(status):
+            self.record_build(None, status=status, command=command, source=source)
             if status == 0:
-                obj.doc = poppler.document_new_from_file('file://' + os.path.abspath(fn+'.pdf'), None)
+                start = time.time()
+                self._load_pdf(self, fn + '.pdf')
+                self.report.add(name, 'load', time.time() - start, start)
+                self.show_timing(self, name)
             if callback:
                 callback(status)
         
-        commands = [[s.format(fn=fn) for s in c.split()] for c in command.split(';')]
-        self.executor.add(commands, stop_on_error, (after_latex,))
+        self.build_index.invalidate(None)
+        self.executor.add([command.split() + pdfs + [fn + '.pdf']],
+                          stop_on_error, (after_assemble,), name=name)
+    
+    @property
+    def cache(self):
+        cachedir = os.path.join(self.build_dir, '.slidedex-cache')
+        if self._cache is None or self._cache.dir != cachedir:
+            self._cache = BuildCache(cachedir, self.settings.cache_size)
+        return self._cache
+    
+    def cache_key(self, parts, command):
+        """Return the key in the build cache of a slide compiled from parts, as
+        returned by compile_parts(), with command, or None without a cache."""
+        if not self.settings.cache_size:
+            return None
+        return slide_key(parts, command)
+    
+    def _do_latex(self, obj, command, callback, stop_on_error, source=None,
+                  priority=CommandExecutor.BACKGROUND, key=None):
+        # obj is either this LatexDocument or one of its LatexSlides.  source,
+        # if given, is the complete source of a slide, and key its key in the
+        # build cache.
+        fn = base_filename(obj.fullfilename)
+        name = os.path.basename(fn)
+        pdffn = fn + '.pdf'
+        if obj is self:
+            # Compile a copy in the build directory, and move just the PDF back.
+            fn = os.path.join(self.build_dir, name)
+        
+        def write_source():
+            # Only once the job starts, since a build of obj may still be
+            # reading the old source.
+            if obj is self:
+                if fn + '.pdf' != pdffn:
+                    shutil.copyfile(self.fullfilename, os.path.join(self.build_dir, self._filename))
+            elif source is not None:
+                f = file(fn + '.tex', 'w')
+                f.write(source)
+                f.close()
+        # The slides the segments of the source belong to.
+        if obj is self:
+            owners = [None, self.header] + list(self.slides) + [self.footer]
+        else:
+            owners = [self.header, obj, self.footer]
+        
+        def after_latex(status, cached=False):
+            if status != 0:
+                self.read_diagnostics(obj, owners, fn, status, source)
+            else:
+                self.clear_diagnostics(obj)
+                # Builds that read other files can't be reused by their source alone.
+                if not cached and key is not None and \
+                        not dependencies(fn, source, self.dir, self.build_dir):
+                    self.cache.store(key, pdffn)
+                if fn + '.pdf' != pdffn:
+                    shutil.move(fn + '.pdf', pdffn)
+                start = time.time()
+                self._load_pdf(obj, pdffn)
+                self.report.add(name, 'load', time.time() - start, start)
+                self.show_timing(obj, name)
+            if callback:
+                callback(status)
+        
+        def fetch(status):
+            start = time.time()
+            if self.cache.fetch(key, pdffn):
+                self.report.add(name, 'cache', time.time() - start, start)
+                after_latex(0, True)
+            else:
+                # Dropped from the cache since.
+                self._do_latex(obj, command, callback, stop_on_error, source, priority)
+        
+        if key is not None and key in self.cache.entries:
+            # The PDF is copied from the cache by a job for obj, like a build,
+            # so that it waits for any build of obj still running, which would
+            # overwrite it, and replaces any still waiting.
+            self.executor.add([CommandExecutor.NOOP], False, (fetch,), parallel=(obj is not self),
+                              target=obj, priority=priority, name=name)
+            return
+        
+        if obj is self:
+            commands = format_commands(command, fn)
+        else:
+            commands = self.slide_commands(command, fn)
+        # Slides are independent of each other, so they may be compiled in
+        # parallel.  The presentation waits for all of them.
+        self.executor.add(commands, stop_on_error, (after_latex,), parallel=(obj is not self),
+                          target=obj, priority=priority, name=name, before=write_source)
+    
+    def slide_commands(self, command, fn):
+        """Return the argvs of command to compile slides from fn.tex, using the
+        precompiled header if there is one."""
+        engine = format_engine(command, self.header.get_content(raw=True),
+                               self.settings.subset_header)
+        return slide_commands(command, fn, engine and self.header_format(engine))
+    
+    def compile_batch(self, slides, callback):
+        """Compile slides, which share a header, in one run of LaTeX, and split the
+        PDF into one for each.  If that fails, the slides are compiled one by one,
+        to find those at fault.  callback(status, slide) is called for each.
+        With a LaTeX from before 2020, every batch falls back to that, as
+        split_commands() explains."""
+        self._batches += 1
+        fn = os.path.join(self.build_dir, '.slidedex-batch%i' % self._batches)
+        name = os.path.basename(fn)
+        command = self.slide_command
+        parts = [p.compile_parts() for p in slides]
+        builds = [p.start_build() for p in slides]
+        source = batch_source(parts)
+        f = file(fn + '.tex', 'w')
+        f.write(source)
+        f.close()
+        
+        def fallback():
+            remove_batch(fn)
+            for p, build in zip(slides, builds):
+                if p.builds == build:  # Not compiled again since
+                    p.compile(lambda status, page=p: callback(status, page), False)
+        
+        def after_latex(status):
+            marks = status == 0 and read_marks(fn + '.log') or []
+            commands = split_commands(marks, len(slides), fn, self.settings.split_command,
+                                      self.settings.merge_command)
+            if commands is None:
+                fallback()
+                return
+            self.executor.add(commands, False, (after_split,), parallel=True, name=name)
+        
+        def after_split(status):
+            if status != 0:
+                fallback()
+                return
+            deps = dependencies(fn, source, self.dir, self.build_dir)
+            for i, (p, build) in enumerate(zip(slides, builds)):
+                if p.builds != build:
+                    continue  # Compiled again since, so this is out of date.
+                pdffn = base_filename(p.fullfilename) + '.pdf'
+                shutil.move('%s-%i.pdf' % (fn, i), pdffn)
+                p.record_build(0, parts[i], command, deps)
+                self.clear_diagnostics(p)
+                self._load_pdf(p, pdffn)
+                callback(0, p)
+            remove_batch(fn)
+        
+        self.executor.add(self.slide_commands(command, fn), False, (after_latex,),
+                          parallel=True, name=name)
+    
+    def set_diagnostics(self, diagnostics):
+        self.diagnostics = diagnostics
+    
+    def read_diagnostics(self, obj, owners, fn, status, source=None):
+        """Read the log of the failed build of obj, from fn.tex, and give each of
+        owners, the slides in order of the segments of the source, its errors
+        and warnings.  Those not in any segment go to obj."""
+        diagnostics = read_log(fn + '.log') or []
+        if not [d for d in diagnostics if d.kind == 'error']:
+            diagnostics.append(Diagnostic('error', "Failed with status %i" % status))
+        if source is None:
+            try:
+                f = file(fn + '.tex', 'r')
+            except IOError:
+                source = ''
+            else:
+                source = f.read()
+                f.close()
+        found = dict((id(o), []) for o in owners + [obj] if o is not None)
+        for d in locate(diagnostics, source, fn + '.tex'):
+            owner = d.segment is not None and d.segment < len(owners) and owners[d.segment] or obj
+            found[id(owner)].append(d)
+        obj.set_diagnostics(found[id(obj)])
+        for owner in (self.header, self.footer):
+            if owner is not obj and found.get(id(owner)):
+                owner.set_diagnostics(found[id(owner)])
+        if obj is self:
+            for p in self.slides:
+                if found.get(id(p)):
+                    p.set_diagnostics(found[id(p)])
+        
+        errors = [(o, d) for o in [obj, self.header, self.footer] + list(self.slides)
+                  for d in found.get(id(o), []) if d.kind == 'error']
+        self.statusbar.pop(self._error_context)
+        if errors:
+            self.statusbar.push(self._error_context, '%s, %s' % (self.describe(errors[0][0]),
+                                                                 errors[0][1]))
+    
+    def clear_diagnostics(self, obj):
+        """Forget the diagnostics of obj, after it was built successfully.  A slide
+        that compiles also shows the header and footer to be fine."""
+        if obj.diagnostics:
+            self.statusbar.pop(self._error_context)
+        obj.set_diagnostics([])
+        if obj is not self:
+            self.header.set_diagnostics([])
+            self.footer.set_diagnostics([])
+    
+    def describe(self, obj):
+        """Name obj, the presentation or one of its slides, for messages."""
+        if obj is self:
+            return "Presentation"
+        if obj is self.header:
+            return "Header"
+        if obj is self.footer:
+            return "Footer"
+        index = self.slides.index(obj)
+        if index is None:
+            return "Slide"
+        return "Slide %i" % (index + 1)
+    
+    def report_failures(self, failed):
+        """Show the errors of all of the slides in failed in one dialog."""
+        lines = []
+        for obj in [self.header, self.footer] + failed:
+            errors = [d for d in obj.diagnostics if d.kind == 'error']
+            lines.extend('%s, %s' % (self.describe(obj), d) for d in errors)
+            if not errors and obj in failed:
+                lines.append('%s failed to compile' % self.describe(obj))
+        if len(lines) > 20:
+            lines[19:] = ['and %i more' % (len(lines) - 19)]
+        dialog = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT,
+                                   gtk.MESSAGE_ERROR, gtk.BUTTONS_CLOSE)
+        dialog.set_markup("<big><b>%s</b></big>\n\n%s" % (
+                len(failed) == 1 and "1 Slide Failed" or "%i Slides Failed" % len(failed),
+                glib.markup_escape_text('\n'.join(lines))))
+        dialog.connect('response', lambda d, r: d.destroy())
+        dialog.show()
+    
+    def show_timing(self, obj, name):
+        """Show how long the last build of obj took in the status bar.  For the
+        presentation, also list the slowest slides."""
+        if obj is self:
+            message = 'Presentation built in ' + self.report.summary(name)
+            times = sorted(((self.report.build_time(os.path.basename(p._filename)), i)
+                            for i, p in enumerate(self.slides) if p._filename), reverse=True)
+            if times:
+                message += '.  Slowest slides: ' + ', '.join('%i (%.2f s)' % (i + 1, t)
+                                                            for t, i in times[:3])
+        else:
+            index = self.slides.index(obj)
+            if index is None:
+                return
+            message = 'Slide %i built in %s' % (index + 1, self.report.summary(name))
+        self.statusbar.pop(self._timing_context)
+        self.statusbar.push(self._timing_context, message)
+    
+    def on_export_report(self, action):
+        dialog = gtk.FileChooserDialog("Export Timing Report...", self.window,
+                                       gtk.FILE_CHOOSER_ACTION_SAVE,
+                                       (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                        gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+        dialog.set_current_name('timings.csv')
+        for title, pattern in (("CSV", '*.csv'), ("JSON", '*.json')):
+            filter = gtk.FileFilter()
+            filter.set_name(title)
+            filter.add_pattern(pattern)
+            dialog.add_filter(filter)
+        if dialog.run() == gtk.RESPONSE_OK:
+            self.report.save(dialog.get_filename())
+        dialog.destroy()
+    
+    @property
+    def build_index(self):
+        path = os.path.join(self.build_dir, '.' + self._filename + '.index')
+        if self._index is None or self._index.path != path:
+            if self._index is not None:
+                self._index.save()
+            self._index = BuildIndex(path)
+        return self._index
+    
+    def record_build(self, name, **fields):
+        """Record the build of the slide with filename name, or of the presentation
+        if name is None, in the build index, which is saved shortly."""
+        self.build_index.record(name, **fields)
+        if self._index_timer is None:
+            self._index_timer = glib.timeout_add_seconds(2, self.save_index)
+    
+    def save_index(self):
+        self._index_timer = None
+        if self._index is not None:
+            self._index.save()
+        return False
+    
+    def _load_pdf(self, obj, pdffn):
+        if obj is self:
+            # LatexSlides do this themselves.
+            self.viewer.cache.discard(self.doc)
+        obj.doc = poppler.document_new_from_file('file://' + os.path.abspath(pdffn), None)
+    
+    def header_format(self, engine):
+        """Return the name of a format file with the header preloaded, or None.
+        
+        The format is named by a hash of the header and footer, so it is only
+        rebuilt when they change.  If it doesn't exist yet, a job to dump it
+        with mylatexformat is queued ahead of the slides that will use it.
+        """
+        if not self.settings.precompile:
+            return None
+        source = format_source(self.header.get_content(raw=True), self.footer.get_content(raw=True))
+        name = format_name(engine, source)
+        if name in self._failed_formats:
+            return None
+        if name == self._format or name == self._format_pending:
+            return name
+        
+        if os.path.exists(os.path.join(self.build_dir, name + '.fmt')):
+            self._format = name
+            return name
+        f = file(os.path.join(self.build_dir, name + '.tex'), 'w')
+        f.write(source)
+        f.close()
+        
+        def after_format(status):
+            self._format_pending = None
+            if status != 0:
+                self._failed_formats.add(name)
+                # The slides waiting for the format are compiled without it.
+                for job in self.executor.command_queue:
+                    for argv in job.commands:
+                        if argv is not CommandExecutor.NOOP and '-fmt=' + name in argv:
+                            argv.remove('-fmt=' + name)
+                return
+            # Remove the format for the previous version of the header.
+            if self._format:
+                for ext in ('.fmt', '.tex', '.log'):
+                    try:
+                        os.unlink(os.path.join(self.build_dir, self._format + ext))
+                    except OSError:
+                        pass
+            self._format = name
+        
+        self._format_pending = name
+        # A failure mustn't clear the queue, which holds the slides to use it.
+        self.executor.add([format_command(engine, name)], False, (after_format,),
+                          priority=CommandExecutor.INTERACTIVE)
+        return name
     
     def get_objects(self, builder):
         for object in ("window", 
@@ -268,6 +803,10 @@ class LatexDocument(object):
                 <menu action="compile">
                     <menuitem action="compile-page"/>
                     <menuitem action="compile-all"/>
+                    <separator/>
+                    <menuitem action="live-compile"/>
+                    <separator/>
+                    <menuitem action="export-report"/>
                 </menu>
                 <menu action="slide" name="Slide">
                     <menuitem action="new-slide-menu" name="NewSlide"/>
@@ -310,6 +849,7 @@ class LatexDocument(object):
                 ('compile', None,       "_Compile"),
                 ('compile-page',    gtk.STOCK_CONVERT, "Compile Page", "<shift>Return", "Compile Page", self.on_compile_page),
                 ('compile-all',     gtk.STOCK_EXECUTE, "Compile Document", "<control><shift>Return", "Compile Document", self.on_compile_all),
+                ('export-report',   None, "_Export Timing Report...", None, None, self.on_export_report),
                 
                 ('slide',  None,   "_Slide"),
                 ('new-slide-menu', gtk.STOCK_NEW,     "_New Slide",       "", None, None),
@@ -319,6 +859,11 @@ class LatexDocument(object):
                 ('prev-slide',  gtk.STOCK_GO_BACK,    "Previous Slide",   "Page_Up",       None, self.on_prev_slide),
         ])
         
+        action_group.add_toggle_actions([
+                ('live-compile',    None, "Compile While _Typing", None,
+                 "Compile the current slide shortly after each edit", self.on_live_compile),
+        ])
+        
         #action = action_group.get_action('new')
         #action.connect_proxy(newbutton)
         
@@ -351,6 +896,18 @@ class LatexDocument(object):
                 menuitem.add_accelerator('activate', self._accel_group, key, mod, gtk.ACCEL_VISIBLE)
                 first = False
     
+    def warn_dvi(self):
+        """Warn if slides are compiled through DVI and PostScript, unless that
+        has been chosen in the settings."""
+        warning = self.settings.dvi_warning(self.header.get_content(raw=True), self._dvi_slides)
+        if warning:
+            dialog = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT,
+                                       gtk.MESSAGE_WARNING, gtk.BUTTONS_CLOSE)
+            dialog.set_markup("<big><b>Slow Compilation</b></big>\n\n" +
+                              glib.markup_escape_text(warning))
+            dialog.connect('response', lambda d, r: d.destroy())
+            dialog.show()
+    
     def on_window_delete(self, widget, event):
         if self.modified:
             dialog = gtk.MessageDialog(self.window, 
@@ -374,10 +931,10 @@ class LatexDocument(object):
         return False
     
     def on_window_destroy(self, widget, data=None):
-        # Delete temp files that (might) reflect unsaved changes
-        docmtime = os.stat(self.fullfilename).st_mtime
-        for p,_ in self.pages:
-            p.del_files_mtime(docmtime)
+        # Files from unsaved changes needn't be deleted, since the index
+        # won't match the saved slides.
+        self.save_index()
+        self.watcher.close()
         gtk.main_quit()
     
     def on_quit(self, action):
@@ -402,8 +959,7 @@ class LatexDocument(object):
         if widget.get_active():
             selection = self.slidelist_view.get_selected_items()
             if selection:
-                currslide, = self.pages.get(self.pages.get_iter(selection[0]), 0)
-                self.viewer.load_doc(currslide.doc)
+                self.viewer.load_doc(self.slides[selection[0][0]].doc)
             else:  # In odd cases, there can be a document, but no slides.
                 self.viewer.load_doc(None)
     
@@ -413,9 +969,9 @@ class LatexDocument(object):
     
     def on_selection_changed(self, view):
         selection = self.slidelist_view.get_selected_items()
-        if len(selection) == 0 and self.prev_selection and len(self.pages):
-            if self.prev_selection[0] >= len(self.pages):
-                self.prev_selection = (len(self.pages) - 1,)
+        if len(selection) == 0 and self.prev_selection and len(self.slides):
+            if self.prev_selection[0] >= len(self.slides):
+                self.prev_selection = (len(self.slides) - 1,)
             self.slidelist_view.select_path(self.prev_selection)
         elif len(selection) == 1:
             # Changing the buffer removes any selection, so we copy the
@@ -424,7 +980,15 @@ class LatexDocument(object):
             if oldbuffer.get_has_selection():
                 oldbuffer.add_selection_clipboard(gtk.clipboard_get("PRIMARY"))
             
-            currslide, = self.pages.get(self.pages.get_iter(selection[0]), 0)
+            currslide = self.slides[selection[0][0]]
+            # The buffer of each slide is only created when it is first shown,
+            # and optionally released some time after it is hidden.
+            lastslide = self._shown_slide
+            currslide.cancel_release()
+            if lastslide is not None and lastslide is not currslide \
+                    and self.settings and self.settings.release_after:
+                lastslide.release_later(self.settings.release_after)
+            self._shown_slide = currslide
             self.currslide_view.set_buffer(currslide.buffer)
             self.currslide_view.set_sensitive(True)
             self.prev_selection = selection[0]
@@ -432,7 +996,7 @@ class LatexDocument(object):
                 self.viewer.load_doc(currslide.doc)
         else:
             self.currslide_view.set_sensitive(False)
-            if len(self.pages) == 0 and self.view_slide_button.get_active():
+            if len(self.slides) == 0 and self.view_slide_button.get_active():
                 self.viewer.load_doc(None)
     
     # Right now, these two are used by drag-and-drop reordering
@@ -457,10 +1021,9 @@ class LatexDocument(object):
         selection = self.slidelist_view.get_selected_items()
         if selection:
             selection = selection[0]
-            iter = self.pages.get_iter(selection)
+            self.add_page(content, index=selection[0]+1)
         else:
-            iter = None
-        self.add_page(content, after=iter)
+            self.add_page(content)
         self.slidelist_view.unselect_all()
         if selection:
             self.slidelist_view.select_path((selection[0]+1,))
@@ -471,9 +1034,9 @@ class LatexDocument(object):
         self.currslide_view.grab_focus()
     
     def on_delete_slide(self, action):
-        for selection in self.slidelist_view.get_selected_items():
-            iter = self.pages.get_iter(selection)
-            self.delete_page(iter)
+        # Delete from the end, so the remaining paths stay valid.
+        for selection in sorted(self.slidelist_view.get_selected_items(), reverse=True):
+            self.delete_page(selection[0])
     
     # http://www.pygtk.org/pygtk2tutorial/sec-TreeViewDragAndDrop.html
     def on_drag_data_get(self, iconview, context, selection_data, target_id, etime):
@@ -489,6 +1052,12 @@ class LatexDocument(object):
         else:
             self.drag_received_create(context, drop_info, selection_data, etime)
     
+    def on_drag_data_delete(self, iconview, context):
+        # Remove moved slides ourselves, rather than letting GTK remove them
+        # from the ListStore behind the back of self.slides.
+        iconview.stop_emission('drag-data-delete')
+        self.on_delete_slide(None)
+    
     def drag_get_reorder(self, selection_data):
         data = repr(self.slidelist_view.get_selected_items())
         selection_data.set(selection_data.target, 8, data)
@@ -504,23 +1073,22 @@ class LatexDocument(object):
             if position not in (gtk.ICON_VIEW_DROP_LEFT, gtk.ICON_VIEW_DROP_ABOVE):
                 index += 1
         else:
-            index = len(self.pages)
+            index = len(self.slides)
         
         index0 = index
-        order = range(len(self.pages))
+        order = range(len(self.slides))
         for d in data:
             order.remove(d)
             if d < index0:
                 index -= 1
         assert(index >= 0)
-        self.pages.reorder(order[:index] + data + order[index:])
+        self.slides.reorder(order[:index] + data + order[index:])
     
     def drag_get_create(self, selection_data):
         data = []
         # Note that this puts the slides in reverse order.
         for selection in self.slidelist_view.get_selected_items():
-            slide, = self.pages.get(self.pages.get_iter(selection), 0)
-            data.append(slide.get_content(raw=True))
+            data.append(self.slides[selection[0]].get_content(raw=True))
         selection_data.set(selection_data.target, 8, SEP.join(data))
     
     def drag_received_create(self, context, drop_info, selection_data, etime):
@@ -529,12 +1097,11 @@ class LatexDocument(object):
         self.slidelist_view.unselect_all()
         if drop_info:
             path, position = drop_info
-            iter = self.pages.get_iter(path)
             if position in (gtk.ICON_VIEW_DROP_LEFT, gtk.ICON_VIEW_DROP_ABOVE):
                 data.reverse()  # Put in forward order, since we'll insert them all
                 newpath = path  # before the same element.
                 for d in data:
-                    self.add_page(d, before=iter, render=True)
+                    self.add_page(d, index=newpath[0], render=True)
                     self.slidelist_view.select_path(newpath)
                     newpath = (newpath[0] + 1,)
                 # Scroll to the right if needed.  (The left will be where we dropped it,
@@ -545,14 +1112,14 @@ class LatexDocument(object):
                 # We want the data in reverse order, since we'll be inserting them
                 # all after the same element.
                 for d in data:
-                    self.add_page(d, after=iter, render=True)
+                    self.add_page(d, index=path[0]+1, render=True)
                     self.slidelist_view.select_path(newpath)
                 self.slidelist_view.scroll_to_path((path[0] + len(data),), False, 0, 0)
         else:
             for d in data:
                 self.add_page(d, render=True)
-                self.slidelist_view.select_path((len(self.pages) - 1,))
-            self.slidelist_view.scroll_to_path((len(self.pages)-1,), False, 0, 0)
+                self.slidelist_view.select_path((len(self.slides) - 1,))
+            self.slidelist_view.scroll_to_path((len(self.slides)-1,), False, 0, 0)
         
         # Run on_selection_changed when we're done rendering all the new pages, so
         # we can load the current document into the viewer.  This doesn't work if
@@ -564,14 +1131,56 @@ class LatexDocument(object):
             context.finish(True, True, etime)
     
     def on_compile_page(self, action):
+        self.finish_loading()  # So the footer is known
         selection = self.slidelist_view.get_selected_items()
         if len(selection) == 1:
-            currslide, = self.pages.get(self.pages.get_iter(selection[0]), 0)
+            currslide = self.slides[selection[0][0]]
             def callback(status):
                 if status == 0:
-                    currslide.render_thumb()
+                    currslide.render_thumb(urgent=True)
                     self.view_slide_button.clicked()
-            currslide.compile(callback)
+            currslide.compile(callback, priority=CommandExecutor.INTERACTIVE)
+    
+    def on_live_compile(self, action):
+        self._live = action.get_active()
+        if self._live and self._shown_slide is not None \
+                and self._shown_slide.modified_since_compile:
+            self.on_slide_edited(self._shown_slide)
+    
+    def on_slide_edited(self, slide):
+        # Compile the current slide once the edits stop for a while.
+        if not self._live or slide is not self._shown_slide or self.settings is None:
+            return
+        if self._live_timer is not None:
+            glib.source_remove(self._live_timer)
+        self._live_timer = glib.timeout_add(self.settings.live_delay, self.live_compile, slide)
+    
+    def live_compile(self, slide):
+        self._live_timer = None
+        self.finish_loading()  # So the footer is known
+        # Supersede any build of an older version, rather than waiting for it.
+        self.executor.cancel(slide)
+        def callback(status):
+            if status == 0:
+                slide.render_thumb(urgent=True)
+                if slide is self._shown_slide and self.view_slide_button.get_active():
+                    self.viewer.load_doc(slide.doc)
+        slide.compile(callback, False, CommandExecutor.INTERACTIVE)
+        return False
+    
+    def on_dependencies_changed(self, slides):
+        """Rebuild the slides that read files which have changed."""
+        for p in slides:
+            if self.slides.index(p) is None:
+                continue  # Deleted since
+            def callback(status, page=p):  # Freeze p
+                if status == 0:
+                    page.render_thumb()
+                    if page is self._shown_slide and self.view_slide_button.get_active():
+                        self.viewer.load_doc(page.doc)
+                else:
+                    page.modified_since_compile = True  # Try again next time
+            p.compile(callback, False)
     
     def on_compile_all(self, action):
         self.compile(lambda status: not status and self.view_presentation_button.clicked())
@@ -581,7 +1190,7 @@ class LatexDocument(object):
         selection = self.slidelist_view.get_selected_items()
         if selection:
             selection = selection[0][0]
-            if selection < len(self.pages)-1:
+            if selection < len(self.slides)-1:
                 self.prev_selection = None
                 self.slidelist_view.unselect_all()
                 self.slidelist_view.select_path((selection+1,))
@@ -0,0 +1,140 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import re
+from misc import SEP
+
+# An error, as printed with -file-line-error.
+FILE_LINE_RE = re.compile(r'^(.*?\.\w+):(\d+): (.+)$')
+# The line of an error, as printed without -file-line-error.
+LINE_RE = re.compile(r'^l\.(\d+) ')
+WARNING_RE = re.compile(r'^(?:(?:La|pdf|Xe|Lua)?TeX|Package (\S+)|Class (\S+)) Warning: (.*)$')
+INPUT_LINE_RE = re.compile(r'on input line (\d+)')
+# Written by batches of slides, giving the number of pages before each.
+MARK_RE = re.compile(r'^SLIDEDEX-MARK (\d+)$', re.M)
+# Errors which only follow others.
+IGNORED = ('Emergency stop.', '==> Fatal error occurred, no output PDF file produced!')
+
+
+class Diagnostic(object):
+    """An error or warning from LaTeX.
+    
+    kind is 'error' or 'warning'.  filename is the file LaTeX was reading,
+    or None if it is the main file or unknown.  line counts from 1, and is
+    None if not known.  Once located, segment is the index of the segment
+    of the source holding line, and line counts from the start of that
+    segment.
+    """
+    
+    def __init__(self, kind, message, filename=None, line=None):
+        self.kind = kind
+        self.message = message
+        self.filename = filename
+        self.line = line
+        self.segment = None
+    
+    def __str__(self):
+        if self.line is None:
+            return self.message
+        if self.segment is None and self.filename is not None:
+            return '%s:%i: %s' % (os.path.basename(self.filename), self.line, self.message)
+        return 'line %i: %s' % (self.line, self.message)
+    
+    def __repr__(self):
+        return 'Diagnostic(%r, %r, %r, %r)' % (self.kind, self.message, self.filename, self.line)
+
+
+def parse_log(text):
+    """Return a list of the Diagnostics in the text of a LaTeX log."""
+    diagnostics = []
+    lines = text.splitlines()
+    error = None  # The last error, while its line isn't known.
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        match = FILE_LINE_RE.match(line)
+        if match and match.group(3) not in IGNORED:
+            diagnostics.append(Diagnostic('error', match.group(3), match.group(1),
+                                          int(match.group(2))))
+            error = None
+            continue
+        if line.startswith('! '):
+            if line[2:] in IGNORED:
+                error = None
+                continue
+            error = Diagnostic('error', line[2:])
+            diagnostics.append(error)
+            continue
+        match = LINE_RE.match(line)
+        if match and error is not None:
+            error.line = int(match.group(1))
+            error = None
+            continue
+        match = WARNING_RE.match(line)
+        if match:
+            package = match.group(1) or match.group(2)
+            message = [match.group(3).strip()]
+            # The warning continues up to a blank line, with its lines
+            # prefixed by the package name.
+            while i < len(lines) and lines[i].strip():
+                cont = lines[i].strip()
+                if package and cont.startswith('(%s)' % package):
+                    cont = cont[len(package) + 2:].strip()
+                message.append(cont)
+                i += 1
+            message = ' '.join(message)
+            match = INPUT_LINE_RE.search(message)
+            diagnostics.append(Diagnostic('warning', message, None,
+                                          match and int(match.group(1)) or None))
+    return diagnostics
+
+def read_log(filename):
+    """Return the Diagnostics from the log file filename, or None if it
+    can't be read."""
+    try:
+        f = file(filename, 'r')
+    except IOError:
+        return None
+    try:
+        return parse_log(f.read())
+    finally:
+        f.close()
+
+def read_marks(filename):
+    """Return the page counts written to the log file filename by MARK_RE
+    lines, or [] if it can't be read."""
+    try:
+        f = file(filename, 'r')
+    except IOError:
+        return []
+    try:
+        return [int(m) for m in MARK_RE.findall(f.read())]
+    finally:
+        f.close()
+
+def segment_starts(source):
+    """Return the lines, counting from 1, of the separators starting each segment
+    of source."""
+    return [i + 1 for i, line in enumerate(source.split('\n')) if line.startswith(SEP)]
+
+def locate(diagnostics, source, filename):
+    """Find the segments of source, the contents of filename, holding the lines
+    of diagnostics.  Those in other files are left alone."""
+    starts = segment_starts(source)
+    for d in diagnostics:
+        if d.line is None or (d.filename is not None and
+                              os.path.basename(d.filename) != os.path.basename(filename)):
+            continue
+        for segment in reversed(range(len(starts))):
+            if d.line >= starts[segment]:
+                # Count from the line after the separator.
+                d.segment = segment
+                d.line = max(d.line - starts[segment], 1)
+                break
+    return diagnostics
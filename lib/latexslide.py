@@ -7,38 +7,74 @@
 
 import os
 import tempfile
-import glob
 import gtk
+import glib
 import gtksourceview2 as sourceview
 import poppler
-from misc import SEP, render_to_pixbuf, base_filename
+from misc import base_filename, format_segment
+from pipeline import slide_parts, slide_source, slide_digests
+from thumbnailer import load_thumb
+from commandexecutor import CommandExecutor
+from buildindex import file_digest
+from dependencies import dependencies
 
 LATEXLANG = sourceview.language_manager_get_default().get_language('latex')
+# The backgrounds of lines with diagnostics, with errors above warnings.
+DIAGNOSTIC_COLORS = (('warning', '#fff3c4'), ('error', '#ffd6d6'))
 
 class LatexSlide(object):
     
-    def __init__(self, parent, content="", filename="", render=False):
+    def __init__(self, parent, content="", filename="", render=False, modified=True):
         self.parent = parent
-        self.buffer = sourceview.Buffer(language=LATEXLANG)
-        self.buffer.connect("modified-changed", self.on_buffer_modified_changed)
-        self.doc = None
+        self._buffer = None  # Created when first needed; until then, we keep _text.
+        self._text = ""
+        self._release_timer = None
+        self._doc = None
+        self._pdf = None
         self.pb = self.parent.window.render_icon(gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG)
         self._filename = filename
-        self._modified_since_save = True  # Set to False at end of document load.
+        self._modified_since_save = modified
         self._modified_since_compile = True
+        self._saved = None  # (filename, content) as last returned by save_content()
+        self.diagnostics = []  # From the last failed build
+        self.builds = 0  # Number of builds started
         self.set_content(content)
         
         cached = False
+        # The build index says whether the slide is up to date, without
+        # looking at its files.  The footer isn't known yet while loading,
+        # so the document checks that later.
         if self._filename:
-            pdffn = base_filename(self.fullfilename) + '.pdf'
-            if os.path.exists(self.fullfilename + '.tex') and os.path.exists(pdffn):
-                self.doc = poppler.document_new_from_file('file://' + os.path.abspath(pdffn), None)
+            digests = slide_digests(self.compile_parts(), self.parent.slide_command)
+            del digests['footer']
+            cached = self.parent.build_index.fresh(self._filename, **digests)
+        if cached:
+            self._pdf = base_filename(self.fullfilename) + '.pdf'
+            pb = load_thumb(self._pdf)
+            if pb is not None:
+                self.set_thumb(pb)
+            else:
                 self.render_thumb()
-                self._modified_since_compile = False
-                cached = True
+            self._modified_since_compile = False
+            self.parent.watcher.watch(self, self.parent.build_index.dependencies(self._filename))
         if render and not cached:
             self.compile(lambda status: not status and self.render_thumb(), False)
     
+    @property
+    def doc(self):
+        # The compiled slide is only opened when first needed, like when shown.
+        if self._doc is None and self._pdf is not None:
+            self._doc = poppler.document_new_from_file('file://' + os.path.abspath(self._pdf), None)
+            self._pdf = None
+        return self._doc
+    
+    @doc.setter
+    def doc(self, doc):
+        if self._doc is not None:
+            self.parent.viewer.cache.discard(self._doc)
+        self._doc = doc
+        self._pdf = None
+    
     @property
     def fullfilename(self):
         # Lazily create filename
@@ -47,28 +83,104 @@ class LatexSlide(object):
             # created before you make it.  But we're not actually using this
             # file; we're using the filename as a base, so the additional
             # features of mkstemp don't help us avoid this problem.
-            filename = tempfile.mktemp(prefix='.tmp', dir=self.parent.dir)
+            filename = tempfile.mktemp(prefix='.tmp', dir=self.parent.build_dir)
             self._filename = os.path.basename(filename)
-        return os.path.join(self.parent.dir, self._filename)
+        return os.path.join(self.parent.build_dir, self._filename)
+    
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            self._buffer = sourceview.Buffer(language=LATEXLANG)
+            self._buffer.connect("modified-changed", self.on_buffer_modified_changed)
+            self._buffer.connect("changed", self.on_buffer_changed)
+            for kind, color in DIAGNOSTIC_COLORS:
+                self._buffer.create_tag(kind, paragraph_background=color)
+            self._set_buffer_text(self._text)
+            self._text = None
+            self._mark_diagnostics()
+        return self._buffer
+    
+    def release_buffer(self):
+        """Drop the buffer, keeping only its text, unless it is being shown.
+        
+        This loses the undo history.  Returns False, so that it may be used
+        as a timeout callback."""
+        self._release_timer = None
+        if self._buffer is not None and self.parent.currslide_view.get_buffer() is not self._buffer:
+            self._text = self._buffer.get_text(self._buffer.get_start_iter(),
+                                               self._buffer.get_end_iter())
+            self._buffer = None
+        return False
+    
+    def release_later(self, seconds):
+        """Release the buffer after seconds, unless cancel_release() is called first."""
+        self.cancel_release()
+        self._release_timer = glib.timeout_add_seconds(seconds, self.release_buffer)
+    
+    def cancel_release(self):
+        """Cancel any release of the buffer started by release_later()."""
+        if self._release_timer is not None:
+            glib.source_remove(self._release_timer)
+            self._release_timer = None
+    
+    def _set_buffer_text(self, content):
+        self._buffer.handler_block_by_func(self.on_buffer_modified_changed)
+        self._buffer.handler_block_by_func(self.on_buffer_changed)
+        self._buffer.begin_not_undoable_action()
+        self._buffer.set_text(content)
+        self._buffer.end_not_undoable_action()
+        self._buffer.set_modified(False)
+        self._buffer.place_cursor(self._buffer.get_start_iter())
+        self._buffer.handler_unblock_by_func(self.on_buffer_modified_changed)
+        self._buffer.handler_unblock_by_func(self.on_buffer_changed)
+    
+    def set_diagnostics(self, diagnostics):
+        """Set the errors and warnings from the last build, and mark their lines."""
+        self.diagnostics = diagnostics
+        if self._buffer is not None:
+            self._mark_diagnostics()
+    
+    def _mark_diagnostics(self):
+        start, end = self._buffer.get_bounds()
+        for kind, color in DIAGNOSTIC_COLORS:
+            self._buffer.remove_tag_by_name(kind, start, end)
+        for d in self.diagnostics:
+            if d.line is not None and d.line <= self._buffer.get_line_count():
+                start = self._buffer.get_iter_at_line(d.line - 1)
+                end = start.copy()
+                end.forward_to_line_end()
+                self._buffer.apply_tag_by_name(d.kind, start, end)
     
     def set_content(self, content=""):
         """Sets the content of the slide, without changing the modification status."""
-        self.buffer.handler_block_by_func(self.on_buffer_modified_changed)
-        self.buffer.begin_not_undoable_action()
-        self.buffer.set_text(content)
-        self.buffer.end_not_undoable_action()
-        self.buffer.set_modified(False)
-        self.buffer.place_cursor(self.buffer.get_start_iter())
-        self.buffer.handler_unblock_by_func(self.on_buffer_modified_changed)
+        self._saved = None
+        if self._buffer is None:
+            self._text = content
+        else:
+            self._set_buffer_text(content)
     
     def get_content(self, raw=False):
-        text = self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter())
-        if not text.endswith('\n'):
-            text += '\n'
+        if self._buffer is None:
+            text = self._text
+        else:
+            text = self._buffer.get_text(self._buffer.get_start_iter(), self._buffer.get_end_iter())
         if raw:
+            if not text.endswith('\n'):
+                text += '\n'
             return text
         else:
-            return SEP + self._filename + '\n' + text
+            return format_segment(self._filename, text)
+    
+    def save_content(self):
+        """Return get_content(), to be saved.  Unless the slide has been modified
+        since it was last saved, the text from then is reused, rather than
+        being read out of the buffer again."""
+        if self._saved is None or self.modified_since_save or self._saved[0] != self._filename:
+            self._saved = (self._filename, self.get_content())
+        return self._saved[1]
+    
+    def on_buffer_changed(self, buffer):
+        self.parent.on_slide_edited(self)
     
     def on_buffer_modified_changed(self, buffer):
         if buffer.get_modified():
@@ -82,8 +194,8 @@ class LatexSlide(object):
     @modified_since_save.setter
     def modified_since_save(self, value):
         self._modified_since_save = value
-        if value == False:
-            self.buffer.set_modified(False)
+        if value == False and self._buffer is not None:
+            self._buffer.set_modified(False)
         self.parent.on_modified_changed()
     
     @property
@@ -93,38 +205,68 @@ class LatexSlide(object):
     @modified_since_compile.setter
     def modified_since_compile(self, value):
         self._modified_since_compile = value
-        if value == False:
-            self.buffer.set_modified(False)
+        if value == False and self._buffer is not None:
+            self._buffer.set_modified(False)
+    
+    def compile_parts(self):
+        """Return the header, content, and footer to compile the slide from, as
+        from slide_parts()."""
+        return slide_parts(self.parent.header.get_content(raw=True), self.get_content(raw=True),
+                           self.parent.footer.get_content(raw=True),
+                           self.parent.settings.subset_header)
     
-    def compile(self, callback=None, stop_on_error=True):
-        f = file(self.fullfilename + '.tex', 'w')
-        f.write(self.parent.header.get_content() + self.get_content() +
-                self.parent.footer.get_content())
-        f.close()
+    def start_build(self):
+        """Note that the slide is being compiled from its current content.  Returns
+        the number of the build, which builds will match until another starts."""
+        self.fullfilename  # So it has a name in the index
+        self.parent.build_index.invalidate(self._filename)
         self.modified_since_compile = False
-        self.do_latex(callback, stop_on_error)
+        self.builds += 1
+        return self.builds
     
-    def do_latex(self, callback, stop_on_error):
-        self.parent._do_latex(self, self.parent.settings.slide_command, callback, stop_on_error)
+    def record_build(self, status, parts, command, deps):
+        """Record the build from parts with command in the build index, and watch
+        the files in deps it read."""
+        output = status == 0 and file_digest(base_filename(self.fullfilename) + '.pdf') or None
+        self.parent.record_build(self._filename, status=status, output=output, deps=deps,
+                                 **slide_digests(parts, command))
+        self.parent.watcher.watch(self, deps.keys())
     
-    def render_thumb(self):
-        if self.doc is not None:
-            self.pb = render_to_pixbuf(self.doc.get_page(0), (300,100))
-        else:
-            self.pb = self.parent.window.render_icon(gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG)
-        for i in range(len(self.parent.pages)):
-            if self.parent.pages[i][0] == self:
-                self.parent.pages[i][1] = self.pb
+    def compile(self, callback=None, stop_on_error=True, priority=CommandExecutor.BACKGROUND):
+        parts = self.compile_parts()
+        self.parent.check_dvi(parts[1])
+        self.start_build()
+        source = slide_source(parts, self._filename)
+        command = self.parent.slide_command
+        
+        def after_compile(status):
+            fn = base_filename(self.fullfilename)
+            self.record_build(status, parts, command,
+                              dependencies(fn, source, self.parent.dir, self.parent.build_dir))
+            if callback:
+                callback(status)
+        
+        self.do_latex(after_compile, stop_on_error, source, priority,
+                      self.parent.cache_key(parts, command))
     
-    def del_files(self):
-        if self._filename:
-            for f in glob.glob(self.fullfilename + '*'):
-                os.unlink(f)
+    def do_latex(self, callback, stop_on_error, source=None, priority=CommandExecutor.BACKGROUND,
+                 key=None):
+        self.parent._do_latex(self, self.parent.slide_command, callback, stop_on_error,
+                              source, priority, key)
     
-    def del_files_mtime(self, mtime):
-        if self._filename:
-            if os.stat(self.fullfilename + '.tex').st_mtime > mtime:
-                self.del_files()
+    def render_thumb(self, urgent=False):
+        """Update the thumbnail, which is rendered in the background."""
+        if self._doc is not None or self._pdf is not None:
+            self.parent.thumbnailer.render(base_filename(self.fullfilename) + '.pdf',
+                                           self.set_thumb, urgent)
+        else:
+            self.set_thumb(self.parent.window.render_icon(gtk.STOCK_MISSING_IMAGE,
+                                                          gtk.ICON_SIZE_DIALOG))
+    
+    def set_thumb(self, pb):
+        self.pb = pb
+        self.parent.slides.changed(self)
+        return False  # So this may be used as an idle callback
 
 class HeaderFooter(LatexSlide):
     
@@ -135,7 +277,7 @@ class HeaderFooter(LatexSlide):
     @modified_since_compile.setter
     def modified_since_compile(self, value):
         if value:
-            for p,_ in self.parent.pages:
+            for p in self.parent.slides:
                 p.modified_since_compile = True
             # Make sure we get notified the next time it changes.
             self.buffer.set_modified(False)
@@ -5,11 +5,49 @@
 #
 ######################################################################
 
-import gtk
+import os
+import re
+import stat
+import tempfile
 
 SEP = "%%SLIDEDEX%%"
 
+# The built-in Beamer themes, and outer theme, that show frame numbers.
+NUMBERED_THEMES = 'AnnArbor|Boadilla|CambridgeUS|Madrid|infolines'
+# Commands whose output depends on other slides, so that a presentation
+# using them can't be assembled from separately compiled slides.  Besides
+# the themes above, the templates set to [frame number] or [page number]
+# print frame numbers.  Footnotes and numbered theorems are counted
+# through the whole presentation.
+CROSS_SLIDE_RE = re.compile(r'\\(ref|pageref|eqref|autoref|cref|Cref|cite\w*|nocite|'
+                            r'tableofcontents|listof\w+|bibliography|printbibliography|'
+                            r'thepage|theframenumber|insert\w*(page|frame|section)\w*|'
+                            r'footnote)\b|'
+                            r'\\use(outer)?theme\s*(\[[^]]*\])?\s*\{\s*(%s)\s*\}|'
+                            r'\{beamer(outer)?theme(%s)\}|'
+                            % (NUMBERED_THEMES, NUMBERED_THEMES) +
+                            r'\\newtheorem\b(?!\*)|\[\s*(frame|page) number\s*\]|'
+                            r'\{theorems\}\s*\[\s*numbered\s*\]')
+# Packages, options, and graphics that only work through DVI and PostScript.
+DVI_ONLY_RE = re.compile(r'\\usepackage(\[[^]]*\])?\{[^}]*\b(pstricks|pst-[\w-]+|psfrag|pstool)\b|'
+                         r'\\documentclass\[[^]]*\bdvips\b|\\(pspicture|psset|special)\b|'
+                         r'[^{},=\s]*\.[eE]?[pP][sS]\s*[},]')
+# Graphics, whose files may be named without an extension.
+GRAPHICS_RE = re.compile(r'\\(?:includegraphics\*?(?:\[[^]]*\])*\{|epsfig\{file=)([^},]+)[},]')
+# The extensions of graphics pdflatex can include, and of those it can't.
+PDF_GRAPHICS = ('.pdf', '.png', '.jpg', '.jpeg')
+PS_GRAPHICS = ('.eps', '.ps')
+# Packages that need a Unicode engine.
+UNICODE_ONLY_RE = re.compile(r'\\usepackage(\[[^]]*\])?\{[^}]*\b(fontspec|unicode-math|polyglossia)\b')
+# Named blocks of the header, and the slides needing them.
+BLOCK_RE = re.compile(r'^%\s*block:\s*([\w-]+)\s*$')
+ENDBLOCK_RE = re.compile(r'^%\s*endblock\s*$')
+NEEDS_RE = re.compile(r'^%\s*needs:(.*)$', re.M)
+
 def render_to_pixbuf(page, msize):
+    # Imported here, so that the rest of this module may be used without
+    # a display, as in headless builds.
+    import gtk
     psize = page.get_size() # floats
     scale = min([s/ps for s, ps in zip(msize, psize)])
     size = [int(ps*scale) for ps in psize]
@@ -22,3 +60,147 @@ def base_filename(fn):
         return fn[:-4]
     else:
         return fn
+
+def search_path_env(docdir):
+    """Return the environment variables that let LaTeX, run from a build
+    directory, find the files \\input, included, or cited from docdir."""
+    env = {}
+    for var in ('TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS'):
+        # The trailing separator keeps the default search path.
+        env[var] = os.pathsep.join(['.', docdir, os.environ.get(var, '')])
+    return env
+
+def iter_segments(fobj):
+    """Yield the (filename, content) of each segment of a SlideDeX file.
+    
+    The file is read a line at a time, so each segment is available as
+    soon as it has been read.  The first segment holds the settings, the
+    second the header, and the last the footer."""
+    line = fobj.readline()
+    if not line.startswith(SEP):
+        raise IOError, "Not a SlideDeX file"
+    filename = ''
+    lines = []
+    for line in fobj:
+        if line.startswith(SEP):
+            yield filename, ''.join(lines)
+            filename = line[len(SEP):].rstrip('\n')
+            lines = []
+        else:
+            lines.append(line)
+    yield filename, ''.join(lines)
+
+def parse_document(fobj):
+    """Split a SlideDeX file into its parts.
+    
+    Returns the settings string, the header, a list of (filename, content)
+    tuples for the slides, and the footer."""
+    segments = list(iter_segments(fobj))
+    if len(segments) < 3:
+        raise IOError, "Could not load from file"
+    return segments[0][1], segments[1][1], segments[2:-1], segments[-1][1]
+
+def format_segment(filename, content):
+    """Format a slide, header, or footer as it appears in a SlideDeX file."""
+    if not content.endswith('\n'):
+        content += '\n'
+    return SEP + filename + '\n' + content
+
+def write_document(fobj, settings, segments):
+    """Write a SlideDeX file to fobj, from the settings, as written by
+    DocumentSettings, and the formatted header, slides, and footer."""
+    fobj.write(SEP + '\n')
+    fobj.write(settings)
+    for segment in segments:
+        fobj.write(segment)
+
+def replace_file(filename, write):
+    """Replace filename with what write(fobj) writes.  It is written to a
+    temporary file, which then replaces the old one, so an interrupted save
+    leaves the old file intact."""
+    filename = os.path.realpath(filename)
+    fd, tmpfn = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                 dir=os.path.dirname(filename))
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        # mkstemp() makes the file private, so give it the usual permissions.
+        if os.path.exists(filename):
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(tmpfn, mode)
+        os.rename(tmpfn, filename)
+    except:
+        os.unlink(tmpfn)
+        raise
+
+def format_commands(command, fn):
+    """Turn a command string from the settings into a list of argvs for fn."""
+    return [[s.format(fn=fn) for s in c.split()] for c in command.split(';')]
+
+def uses_cross_slide_state(text):
+    """Whether text uses page numbers, references, or other state shared between slides."""
+    return CROSS_SLIDE_RE.search(text) is not None
+
+def needs_dvi(text, docdir=None):
+    """If text can only be compiled through DVI, return the text responsible.
+    Graphics named without an extension count if docdir has them only as
+    PostScript."""
+    match = DVI_ONLY_RE.search(text)
+    if match:
+        # For packages, name just the package.
+        return match.group(2) or match.group(0).rstrip('},').strip()
+    if docdir is None:
+        return None
+    for match in GRAPHICS_RE.finditer(text):
+        path = os.path.join(docdir, match.group(1).strip())
+        if os.path.splitext(path)[1] or [e for e in PDF_GRAPHICS if os.path.exists(path + e)]:
+            continue
+        for ext in PS_GRAPHICS:
+            if os.path.exists(path + ext):
+                return match.group(1).strip() + ext
+    return None
+
+def header_blocks(header):
+    """Return the names of the blocks in header."""
+    return [m.group(1) for m in (BLOCK_RE.match(l) for l in header.split('\n')) if m]
+
+def slide_needs(content):
+    """Return the set of header blocks named in the '% needs:' lines of content."""
+    return set(name for m in NEEDS_RE.finditer(content)
+               for name in m.group(1).replace(',', ' ').split())
+
+def subset_header(header, needs):
+    """Return header without the blocks not named in needs.
+    
+    A block starts with a line '% block: name' and runs to '% endblock',
+    or the next block.  The lines of the blocks left out are emptied, so
+    the others keep their line numbers."""
+    lines = header.split('\n')
+    block = None
+    for i, line in enumerate(lines):
+        match = BLOCK_RE.match(line)
+        if match:
+            block = match.group(1)
+        elif ENDBLOCK_RE.match(line):
+            block = None
+        elif block is not None and block not in needs:
+            lines[i] = ''
+    return '\n'.join(lines)
+
+def choose_engine(header, docdir=None):
+    """Return the fastest engine profile that can compile header, with its
+    graphics in docdir."""
+    if needs_dvi(header, docdir):
+        return 'latex'
+    if UNICODE_ONLY_RE.search(header):
+        return 'xelatex'
+    return 'pdflatex'
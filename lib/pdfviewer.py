@@ -6,11 +6,55 @@
 ######################################################################
 
 import gtk
+import glib
 import poppler
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 from misc import render_to_pixbuf
 
 
+class PixbufCache(object):
+    """Rendered pages, keyed by (document, page index, size).
+    
+    Once the pixbufs take up more than max_size bytes, the least recently
+    used are dropped."""
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._pixbufs = OrderedDict()
+    
+    def get(self, key):
+        pb = self._pixbufs.pop(key, None)
+        if pb is not None:
+            self._pixbufs[key] = pb
+        return pb
+    
+    def put(self, key, pb):
+        self._remove(key)
+        self._pixbufs[key] = pb
+        self.size += pb.get_rowstride() * pb.get_height()
+        while self.size > self.max_size and len(self._pixbufs) > 1:
+            self._remove(iter(self._pixbufs).next())
+    
+    def _remove(self, key):
+        pb = self._pixbufs.pop(key, None)
+        if pb is not None:
+            self.size -= pb.get_rowstride() * pb.get_height()
+    
+    def discard(self, doc):
+        """Drop all pages of doc, as when it has been recompiled."""
+        for key in [k for k in self._pixbufs if k[0] is doc]:
+            self._remove(key)
+
+
 class PDFViewer(object):
+    
+    CACHE_SIZE = 64 * 1024 * 1024  # bytes
+    PREFETCH = 2  # Number of pages on either side of the current one to render ahead
+    
     def __init__(self, builder):
         self.prev_button = builder.get_object("prev_button")
         self.next_button = builder.get_object("next_button")
@@ -26,8 +70,11 @@ class PDFViewer(object):
         self.doc = None
         self.npages = -1
         self.currpage = -1
+        self.cache = PixbufCache(self.CACHE_SIZE)
+        self._prefetch_id = None
     
     def _load(self):
+        self.cancel_prefetch()
         if self.doc is not None:
             self.npages = self.doc.get_n_pages()
             self.npage_label.set_text(" of %i"%self.npages)
@@ -80,10 +127,47 @@ class PDFViewer(object):
         self.page_entry.set_text(str(self.currpage+1))
         self.render()
     
+    def get_pixbuf(self, page, size):
+        key = (self.doc, page, size)
+        pb = self.cache.get(key)
+        if pb is None:
+            pb = render_to_pixbuf(self.doc.get_page(page), size)
+            self.cache.put(key, pb)
+        return pb
+    
     def render(self):
         if self.doc is not None:
             rect = self.view_image.get_allocation()
-            pb = render_to_pixbuf(self.doc.get_page(self.currpage), (rect.width, rect.height))
-            self.view_image.set_from_pixbuf(pb)
+            size = (rect.width, rect.height)
+            self.view_image.set_from_pixbuf(self.get_pixbuf(self.currpage, size))
+            self.start_prefetch(size)
         else:
             self.view_image.set_from_icon_name(gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG)
+    
+    def start_prefetch(self, size):
+        """Render the pages around the current one into the cache, while idle."""
+        self.cancel_prefetch()
+        pages = []
+        for i in range(1, self.PREFETCH + 1):
+            pages.extend([p for p in (self.currpage + i, self.currpage - i)
+                          if 0 <= p < self.npages])
+        if pages:
+            self._prefetch_id = glib.idle_add(self._prefetch, self.doc, size, pages,
+                                              priority=glib.PRIORITY_LOW)
+    
+    def cancel_prefetch(self):
+        if self._prefetch_id is not None:
+            glib.source_remove(self._prefetch_id)
+            self._prefetch_id = None
+    
+    def _prefetch(self, doc, size, pages):
+        rect = self.view_image.get_allocation()
+        if doc is not self.doc or size != (rect.width, rect.height):
+            # Pages of this size won't be wanted.
+            self._prefetch_id = None
+            return False
+        self.get_pixbuf(pages.pop(0), size)
+        if not pages:
+            self._prefetch_id = None
+            return False
+        return True
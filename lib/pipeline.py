@@ -0,0 +1,150 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+# The steps of building a presentation, shared by the editor and headless
+# builds, which each run the commands in their own way.
+
+import os
+import hashlib
+from misc import format_segment, format_commands, uses_cross_slide_state, header_blocks, \
+                 slide_needs, subset_header
+from buildcache import BuildCache
+from buildindex import digest
+
+# Written to the log between the slides of a batch, with the number of
+# pages so far.
+MARK = '\\immediate\\write-1{SLIDEDEX-MARK \\the\\ReadonlyShipoutCounter}\n'
+
+def slide_parts(header, content, footer, subset=False):
+    """Return the header, content, and footer to compile a slide from, given
+    their raw text.  If subset, the header has only the blocks the slide
+    needs.  The content is left without its separator, so that the parts
+    don't depend on the filename, and copies of a slide share their builds."""
+    if not content.endswith('\n'):
+        content += '\n'
+    if subset:
+        header = subset_header(header, slide_needs(content))
+    return format_segment('', header), content, format_segment('', footer)
+
+def slide_source(parts, filename):
+    """Return the source of the slide filename, as compiled from parts."""
+    header, content, footer = parts
+    return header + format_segment(filename, content) + footer
+
+def slide_key(parts, command):
+    """Return the key in the build cache of a slide compiled from parts with command."""
+    return BuildCache.key(''.join(parts), command)
+
+def slide_digests(parts, command):
+    """Return the fields of the build index that say what a slide was compiled from."""
+    header, content, footer = [digest(p) for p in parts]
+    return dict(header=header, content=content, footer=footer, command=command)
+
+def slide_filename(content, taken):
+    """Return a name for the build of a slide that has none, which stays the
+    same from one build to the next while content does.  The names in
+    taken are avoided."""
+    base = '.slide-' + hashlib.sha1(content).hexdigest()[:12]
+    filename, i = base, 1
+    while filename in taken:
+        filename = '%s-%i' % (base, i)
+        i += 1
+    return filename
+
+def can_assemble(mode, header, slides, footer):
+    """Whether the presentation, with the texts of its header, slides, and
+    footer, may be built by joining the PDFs of the slides, given the
+    assemble setting mode."""
+    if mode == 'never' or not slides:
+        return False
+    if mode == 'always':
+        return True
+    return not [t for t in [header, footer] + list(slides) if uses_cross_slide_state(t)]
+
+def format_engine(command, header, subset):
+    """Return the engine to dump a format of the header with, for slides
+    compiled with command, or None if they can't use one.
+    
+    Formats are only dumped for engines known to handle it, and not through
+    wrappers like latexmk.  A format holds the whole header, so it isn't
+    used when slides get only parts of it."""
+    engine = format_commands(command, '')[0][0]
+    if engine not in ('latex', 'pdflatex') or (subset and header_blocks(header)):
+        return None
+    return engine
+
+def format_source(header, footer):
+    """Return the source, from the raw header and footer, to dump a format from."""
+    return format_segment('', header) + format_segment('', footer)
+
+def format_name(engine, source):
+    """Return the name of the format dumped by engine from source.  This changes
+    only with the header and footer."""
+    return '.slidedex-' + hashlib.sha1(engine + '\0' + source).hexdigest()[:16]
+
+def format_command(engine, name):
+    """Return the argv dumping the format name from name.tex with mylatexformat."""
+    return [engine, '-ini', '-halt-on-error', '-jobname=' + name,
+            '&' + engine, 'mylatexformat.ltx', name + '.tex']
+
+def slide_commands(command, fn, format=None):
+    """Return the argvs of command to compile a slide from fn.tex, with the
+    precompiled header format, if given."""
+    commands = format_commands(command, fn)
+    if format:
+        commands[0].insert(1, '-fmt=' + format)
+    return commands
+
+def can_batch(parts):
+    """Whether a slide, compiled from parts, may be put in a batch.  The slides
+    of a batch share counters, like those of pages and frames, so slides
+    using state shared between slides are compiled on their own, as they
+    would give different output in a batch."""
+    return not [p for p in parts if uses_cross_slide_state(p)]
+
+def batch_source(parts):
+    """Return the source to compile slides, from a list of the parts of each,
+    in one run.  They must share a header and footer.  Groups keep the
+    definitions in one slide from affecting the rest."""
+    return ''.join([parts[0][0]] + [MARK + '\\begingroup\n' + content + '\\endgroup\n'
+                                    for header, content, footer in parts]
+                   + [MARK, parts[0][2]])
+
+def split_commands(marks, count, fn, split, merge):
+    """Return the argvs to split fn.pdf, from a batch of count slides, into
+    fn-0.pdf, fn-1.pdf, and so on, given the marks read from its log.
+    Returns None if the marks don't fit, so the batch can't be split.
+    
+    The log gives the number of pages before each slide, so that slides
+    with overlays are split properly.  This needs a LaTeX from 2020 or
+    later, for \\ReadonlyShipoutCounter."""
+    if len(marks) != count + 1 or [a for a, b in zip(marks, marks[1:]) if a >= b]:
+        return None
+    split = split.split()
+    merge = merge.split()
+    commands = []
+    for i, (first, last) in enumerate(zip(marks, marks[1:])):
+        pdf = '%s-%i.pdf' % (fn, i)
+        if last == first + 1:
+            commands.append(split + ['-f', str(last), '-l', str(last), fn + '.pdf', pdf])
+        else:
+            # Take out each page, and join them again.
+            commands.append(split + ['-f', str(first + 1), '-l', str(last), fn + '.pdf',
+                                     '%s-%i-%%d.pdf' % (fn, i)])
+            commands.append(merge + ['%s-%i-%i.pdf' % (fn, i, page)
+                                     for page in range(first + 1, last + 1)] + [pdf])
+    return commands
+
+def remove_batch(fn):
+    """Delete the files of the batch compiled from fn.tex."""
+    dir, prefix = os.path.split(fn)
+    for filename in os.listdir(dir):
+        if filename.startswith(prefix + '.') or filename.startswith(prefix + '-'):
+            try:
+                os.unlink(os.path.join(dir, filename))
+            except OSError:
+                pass
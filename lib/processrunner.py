@@ -0,0 +1,113 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import errno
+import signal
+import subprocess
+from collections import deque
+import glib
+
+
+class OutputBuffer(object):
+    """Collects the output of processes, keeping only the last max_size bytes."""
+    
+    def __init__(self, max_size=64*1024):
+        self.max_size = max_size
+        self._chunks = deque()
+        self._size = 0
+        self.dropped = 0
+    
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.max_size:
+            chunk = self._chunks.popleft()
+            excess = self._size - self.max_size
+            if len(chunk) > excess:
+                self._chunks.appendleft(chunk[excess:])
+                chunk = chunk[:excess]
+            self._size -= len(chunk)
+            self.dropped += len(chunk)
+    
+    def getvalue(self):
+        value = ''.join(self._chunks)
+        if self.dropped:
+            return '[%i bytes of output omitted]\n' % self.dropped + value
+        return value
+
+
+class Process(object):
+    """A child process run from the glib main loop, without a terminal.
+    
+    Its standard output and error are collected in output, an OutputBuffer.
+    Standard input is empty, so programs stop rather than prompting.  Once
+    the process has exited and all of its output has been read,
+    callback(status, output) is called; status is the exit code, or minus
+    the number of the signal that killed it.  Variables in env are added
+    to its environment.  This needs only glib, not GTK.
+    """
+    
+    def __init__(self, argv, cwd, callback, output=None, env=None):
+        self.callback = callback
+        self.output = output if output is not None else OutputBuffer()
+        self.status = None
+        self._eof = False
+        devnull = file(os.devnull, 'r')
+        try:
+            self.popen = subprocess.Popen(argv, cwd=cwd, env=dict(os.environ, **(env or {})),
+                                          stdin=devnull, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT, close_fds=True)
+        except OSError, e:
+            self.popen = None
+            self.output.write('%s: %s\n' % (argv[0], e.strerror))
+            self.status = 127
+            self._eof = True
+            # Report back from the main loop, as for a process that ran.
+            glib.idle_add(self._finish)
+            return
+        finally:
+            devnull.close()
+        glib.io_add_watch(self.popen.stdout, glib.IO_IN | glib.IO_HUP | glib.IO_ERR,
+                          self._on_output)
+        glib.child_watch_add(self.popen.pid, self._on_exit)
+    
+    def kill(self):
+        if self.popen is not None and self.status is None:
+            try:
+                os.kill(self.popen.pid, signal.SIGTERM)
+            except OSError:
+                pass  # Already finished
+    
+    def _on_output(self, source, condition):
+        try:
+            data = os.read(source.fileno(), 4096)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = ''
+        if data:
+            self.output.write(data)
+            return True
+        source.close()
+        self._eof = True
+        self._finish()
+        return False
+    
+    def _on_exit(self, pid, condition):
+        if os.WIFSIGNALED(condition):
+            self.status = -os.WTERMSIG(condition)
+        else:
+            self.status = os.WEXITSTATUS(condition)
+        # glib has reaped the child, so Popen must not try to.
+        self.popen.returncode = self.status
+        self._finish()
+    
+    def _finish(self):
+        if self._eof and self.status is not None:
+            self.callback(self.status, self.output)
+        return False
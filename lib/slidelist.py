@@ -0,0 +1,101 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+
+class SlideList(object):
+    """The ordered slides of a presentation, independent of GTK.
+    
+    Views, like the ListStore behind the slide list, mirror this by
+    connecting a listener, which is called as listener(event, *args) after
+    each change:
+        
+        'inserted', index, slide
+        'deleted', index, slide
+        'reordered', new_order      (new_order[new index] = old index)
+        'changed', index, slide
+        'cleared'
+    
+    The index of a slide is looked up through a dictionary, which is only
+    brought up to date past the point of the last insertion or deletion
+    when needed.
+    """
+    
+    def __init__(self):
+        self._slides = []
+        self._index = {}
+        self._valid = 0  # _index is correct for slides before this point
+        self._listeners = []
+    
+    def connect(self, listener):
+        self._listeners.append(listener)
+    
+    def _notify(self, event, *args):
+        for listener in self._listeners:
+            listener(event, *args)
+    
+    def __len__(self):
+        return len(self._slides)
+    
+    def __iter__(self):
+        return iter(self._slides)
+    
+    def __getitem__(self, index):
+        return self._slides[index]
+    
+    def __contains__(self, slide):
+        return self.index(slide) is not None
+    
+    def index(self, slide):
+        """Return the position of slide, or None if it is not in the list."""
+        i = self._index.get(slide)
+        if i is not None and i < self._valid:
+            return i
+        for j in xrange(self._valid, len(self._slides)):
+            self._index[self._slides[j]] = j
+        self._valid = len(self._slides)
+        return self._index.get(slide)
+    
+    def _invalidate(self, index):
+        self._valid = min(self._valid, index)
+    
+    def insert(self, index, slide):
+        if index is None:
+            index = len(self._slides)
+        self._slides.insert(index, slide)
+        self._index[slide] = index
+        if index == len(self._slides) - 1 and self._valid == index:
+            self._valid += 1
+        else:
+            self._invalidate(index)
+        self._notify('inserted', index, slide)
+    
+    def append(self, slide):
+        self.insert(None, slide)
+    
+    def remove(self, index):
+        slide = self._slides.pop(index)
+        del self._index[slide]
+        self._invalidate(index)
+        self._notify('deleted', index, slide)
+        return slide
+    
+    def reorder(self, new_order):
+        self._slides = [self._slides[i] for i in new_order]
+        self._invalidate(next((i for i, old in enumerate(new_order) if i != old), len(self)))
+        self._notify('reordered', new_order)
+    
+    def changed(self, slide):
+        """Notify listeners that slide has changed, such as by getting a new thumbnail."""
+        index = self.index(slide)
+        if index is not None:
+            self._notify('changed', index, slide)
+    
+    def clear(self):
+        self._slides = []
+        self._index = {}
+        self._valid = 0
+        self._notify('cleared')
@@ -0,0 +1,90 @@
+# Copyright 2011 Robert Schroll
+#
+# This file is part of SlideDeX and is distributed under the terms of
+# the BSD license.  See the file COPYING for full details.
+#
+######################################################################
+
+import os
+import time
+import threading
+import traceback
+import Queue
+import glib
+import gtk
+import poppler
+from misc import render_to_pixbuf
+
+# The rendering thread hands its results back through idle callbacks.
+glib.threads_init()
+
+THUMB_SIZE = (300, 100)
+MTIME_KEY = 'tEXt::slidedex-pdf-mtime'
+
+def thumb_filename(pdffn):
+    return pdffn[:-len('.pdf')] + '.thumb.png'
+
+def load_thumb(pdffn):
+    """Return the saved thumbnail for pdffn, or None if there isn't an up-to-date one."""
+    try:
+        pb = gtk.gdk.pixbuf_new_from_file(thumb_filename(pdffn))
+        mtime = repr(os.stat(pdffn).st_mtime)
+    except (glib.GError, OSError):
+        return None
+    if pb.get_option(MTIME_KEY) != mtime:
+        return None
+    return pb
+
+
+class Thumbnailer(object):
+    """Renders thumbnails of PDFs in a background thread.
+    
+    Each thumbnail is saved as a PNG next to its PDF, tagged with the
+    modification time of the PDF, so that it may be reloaded by load_thumb()
+    without involving Poppler.  If a BuildReport is given, the time taken
+    for each is recorded in it, under the base filename of the PDF."""
+    
+    def __init__(self, report=None):
+        self.report = report
+        self.queue = Queue.PriorityQueue()
+        self.count = 0  # Keeps requests of the same priority in order
+        self.thread = None
+    
+    def render(self, pdffn, callback, urgent=False):
+        """Render the first page of pdffn, and pass the pixbuf to callback, from
+        the main loop.  Urgent requests, for slides the user is waiting on, are
+        handled before the others."""
+        self.count += 1
+        self.queue.put((not urgent, self.count, pdffn, callback))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def _run(self):
+        while True:
+            urgent, count, pdffn, callback = self.queue.get()
+            start = time.time()
+            try:
+                mtime = repr(os.stat(pdffn).st_mtime)
+                # Open our own copy, so the document is never shared between threads.
+                doc = poppler.document_new_from_file('file://' + os.path.abspath(pdffn), None)
+                pb = render_to_pixbuf(doc.get_page(0), THUMB_SIZE)
+                pb.save(thumb_filename(pdffn), 'png', {MTIME_KEY: mtime})
+            except (glib.GError, OSError):
+                # The PDF may have been removed or be in the middle of being
+                # rewritten, in which case another request will follow.
+                continue
+            except Exception:
+                # Anything else is a bug, but mustn't stop the thumbnails
+                # of the other slides.
+                traceback.print_exc()
+                continue
+            glib.idle_add(self._deliver, pdffn, start, time.time() - start, callback, pb)
+    
+    def _deliver(self, pdffn, start, seconds, callback, pb):
+        # The report is only touched from the main loop.
+        if self.report is not None:
+            self.report.add(os.path.basename(pdffn[:-len('.pdf')]), 'thumbnail', seconds, start)
+        callback(pb)
+        return False